@@ -1,15 +1,117 @@
 # Copyright (c) 2020 DeNA Co., Ltd.
 # Licensed under The MIT License [see LICENSE for details]
 
-import io
 import time
+import math
 import struct
 import socket
 import pickle
 import threading
 import queue
 import select
+import zlib
 import multiprocessing as mp
+import multiprocessing.connection
+from multiprocessing.reduction import ForkingPickler
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+# wire compression codecs (name -> (frame flag, compress, decompress))
+compression_codecs = {'zlib': (1, lambda b: zlib.compress(b, 1), zlib.decompress)}
+if lz4 is not None:
+    compression_codecs['lz4'] = (2, lz4.frame.compress, lz4.frame.decompress)
+decompression_codecs = {flag: decompress for flag, _, decompress in compression_codecs.values()}
+
+
+def select_compression(codec):
+    # fall back to zlib if requested codec is not available here
+    if codec is None or codec in compression_codecs:
+        return codec
+    return 'zlib'
+
+
+def compressible(buf, compress, rate=0.95):
+    # probe middle of payload to skip data that is already compressed
+    mid = len(buf) // 2
+    sample = buf[max(0, mid - 2048):mid + 2048]
+    return len(compress(sample)) < len(sample) * rate
+
+
+class TrafficStats:
+    # thread-safe counters and power-of-two histograms of communication
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start_time = time.time()
+            self.counters = {}
+            self.histograms = {}
+
+    def add(self, keys, value=1):
+        with self.lock:
+            for key in keys:
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, key, value):
+        bucket = math.frexp(value)[1] if value > 0 else None  # value < 2 ** bucket
+        with self.lock:
+            hist = self.histograms.setdefault(key, {'count': 0, 'sum': 0, 'buckets': {}})
+            hist['count'] += 1
+            hist['sum'] += value
+            hist['buckets'][bucket] = hist['buckets'].get(bucket, 0) + 1
+
+    def record(self, direction, labels, size):
+        self.add([(direction, label, 'msgs') for label in labels])
+        self.add([(direction, label, 'bytes') for label in labels], size)
+        self.observe((direction, 'size'), size)
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = max(time.time() - self.start_time, 1e-6)
+            return {
+                'elapsed': elapsed,
+                'counters': dict(self.counters),
+                'rates': {key: value / elapsed for key, value in self.counters.items()},
+                'histograms': {key: {**hist, 'buckets': dict(hist['buckets'])} for key, hist in self.histograms.items()},
+            }
+
+
+def format_stats(name, stats):
+    # log lines of traffic per second in total and for each command type
+    lines = []
+    labels = sorted(set(key[1] for key in stats['rates'] if key[0] in ('send', 'recv')))
+    for label in ['all'] + [label for label in labels if label.startswith('command ')]:
+        line = '%s %s:' % (name, label)
+        for direction in ['recv', 'send']:
+            line += ' %s %.1f msg/s %.1f KB/s' % (
+                direction,
+                stats['rates'].get((direction, label, 'msgs'), 0),
+                stats['rates'].get((direction, label, 'bytes'), 0) / 1024,
+            )
+        if label == 'all':
+            line += ' queue %s' % ' '.join('%s %d' % item for item in stats['queues'].items())
+            line += ' time %s' % ' '.join(
+                '%s %.3fs' % (key[1], hist['sum'])
+                for key, hist in sorted(stats['histograms'].items()) if key[0] == 'time'
+            )
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+class Serialized:
+    # object pickled only once to be sent many times
+    def __init__(self, obj):
+        self.buf = pickle.dumps(obj)
+
+    def __reduce__(self):
+        # receivers get the original object
+        return pickle.loads, (self.buf,)
 
 
 def send_recv(conn, sdata):
@@ -18,9 +120,23 @@ def send_recv(conn, sdata):
     return rdata
 
 
+def send_recv_many(conn, sdata_list):
+    # pipelined requests written at once, whose replies come back in the same order
+    if isinstance(conn, PickledConnection):
+        conn.send_bytes_many([pickle.dumps(sdata) for sdata in sdata_list])
+    else:
+        for sdata in sdata_list:
+            conn.send(sdata)
+    return [conn.recv() for _ in sdata_list]
+
+
 class PickledConnection:
     def __init__(self, conn):
         self.conn = conn
+        self.codec = None
+        self.compress_threshold = 0
+        self.saved_bytes = {'send': 0, 'recv': 0}
+        self.recv_buf = bytearray()
 
     def __del__(self):
         self.close()
@@ -33,41 +149,77 @@ class PickledConnection:
     def fileno(self):
         return self.conn.fileno()
 
+    def set_compression(self, codec, threshold=16384):
+        self.codec = select_compression(codec)
+        self.compress_threshold = threshold
+
     def _recv(self, size):
-        buf = io.BytesIO()
-        while size > 0:
-            chunk = self.conn.recv(size)
+        # read ahead to receive coalesced frames in fewer syscalls
+        while len(self.recv_buf) < size:
+            chunk = self.conn.recv(max(size - len(self.recv_buf), 65536))
             if len(chunk) == 0:
                 raise ConnectionResetError
-            size -= len(chunk)
-            buf.write(chunk)
+            self.recv_buf += chunk
+        buf = bytes(self.recv_buf[:size])
+        del self.recv_buf[:size]
         return buf
 
-    def recv(self):
-        buf = self._recv(4)
-        size, = struct.unpack("!i", buf.getvalue())
+    def buffered(self):
+        # whether a whole frame is already read ahead (select() cannot see it)
+        if len(self.recv_buf) < 5:
+            return False
+        size, _ = struct.unpack_from("!iB", self.recv_buf)
+        return len(self.recv_buf) >= 5 + size
+
+    def recv_bytes(self):
+        size, flag = struct.unpack("!iB", self._recv(5))
         buf = self._recv(size)
-        return pickle.loads(buf.getvalue())
+        if flag != 0:
+            n = len(buf)
+            buf = decompression_codecs[flag](buf)
+            self.saved_bytes['recv'] += len(buf) - n
+        return buf
 
-    def _send(self, buf):
-        size = len(buf)
-        while size > 0:
-            n = self.conn.send(buf)
-            size -= n
-            buf = buf[n:]
+    def recv(self):
+        return pickle.loads(self.recv_bytes())
+
+    def _send(self, chunks):
+        # vectored write of all chunks
+        chunks = [memoryview(chunk) for chunk in chunks if len(chunk) > 0]
+        while len(chunks) > 0:
+            n = self.conn.sendmsg(chunks[:1024])
+            while n > 0:
+                if n >= len(chunks[0]):
+                    n -= len(chunks.pop(0))
+                else:
+                    chunks[0] = chunks[0][n:]
+                    n = 0
+
+    def _compress(self, buf):
+        if self.codec is None or len(buf) < self.compress_threshold:
+            return buf, 0
+        flag, compress, _ = compression_codecs[self.codec]
+        if not compressible(buf, compress):
+            return buf, 0
+        cbuf = compress(buf)
+        if len(cbuf) >= len(buf):
+            return buf, 0
+        self.saved_bytes['send'] += len(buf) - len(cbuf)
+        return cbuf, flag
+
+    def _frame(self, buf):
+        buf, flag = self._compress(buf)
+        return [struct.pack("!iB", len(buf), flag), buf]
+
+    def send_bytes(self, buf):
+        self._send(self._frame(buf))
+
+    def send_bytes_many(self, bufs):
+        # coalesce messages into one vectored write
+        self._send(sum([self._frame(buf) for buf in bufs], []))
 
     def send(self, msg):
-        buf = pickle.dumps(msg)
-        n = len(buf)
-        header = struct.pack("!i", n)
-        if n > 16384:
-            chunks = [header, buf]
-        elif n > 0:
-            chunks = [header + buf]
-        else:
-            chunks = [header]
-        for chunk in chunks:
-            self._send(chunk)
+        self.send_bytes(pickle.dumps(msg))
 
 
 def open_socket_connection(port, reuse=False):
@@ -94,13 +246,21 @@ def listen_socket_connections(n, port):
     return [accept_socket_connection(sock) for _ in range(n)]
 
 
-def connect_socket_connection(host, port):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        sock.connect((host, int(port)))
-    except ConnectionRefusedError:
-        print('failed to connect %s %d' % (host, port))
-    return PickledConnection(sock)
+def connect_socket_connection(host, port, retry=False, max_interval=60):
+    interval = 1
+    while True:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect((host, int(port)))
+            return PickledConnection(sock)
+        except OSError:
+            sock.close()
+            print('failed to connect %s %d' % (host, port))
+            if not retry:
+                raise
+        # retry with exponential backoff
+        time.sleep(interval)
+        interval = min(interval * 2, max_interval)
 
 
 def accept_socket_connections(port, timeout=None, maxsize=1024):
@@ -132,73 +292,144 @@ def open_multiprocessing_connections(num_process, target, args_func):
 
 
 class MultiProcessWorkers:
-    def __init__(self, func, send_generator, num, postprocess=None, buffer_length=512, num_receivers=1):
+    # all processes are started at first, and work is sent only to the first num_active ones
+    def __init__(self, func, send_generator, num, postprocess=None, buffer_length=512, num_receivers=1, num_active=None):
         self.send_generator = send_generator
         self.postprocess = postprocess
         self.buffer_length = buffer_length
         self.num_receivers = num_receivers
+        self.num_active = num_active if num_active is not None else num
         self.conns = []
-        self.send_cnt = {}
+        self.credits = {}
         self.shutdown_flag = False
-        self.lock = threading.Lock()
+        self.credit_cond = threading.Condition()
+        self.input_queue = queue.Queue(maxsize=8)
         self.output_queue = queue.Queue(maxsize=8)
         self.threads = []
+        self.traffic = TrafficStats()
 
         for i in range(num):
             conn0, conn1 = mp.Pipe(duplex=True)
-            mp.Process(target=func, args=(conn1, i)).start()
+            # daemon not to block exit since a child keeps its own copy of the parent side
+            mp.Process(target=func, args=(conn1, i), daemon=True).start()
             conn1.close()
             self.conns.append(conn0)
-            self.send_cnt[conn0] = 0
+            self.credits[conn0] = buffer_length
 
     def shutdown(self):
         self.shutdown_flag = True
+        with self.credit_cond:
+            self.credit_cond.notify_all()
         for thread in self.threads:
             thread.join()
 
     def recv(self):
-        return self.output_queue.get()
+        # returns None after shutdown since receivers no longer put data
+        while not self.shutdown_flag:
+            try:
+                return self.output_queue.get(timeout=0.3)
+            except queue.Empty:
+                pass
+        return None
+
+    def set_num_active(self, num_active):
+        with self.credit_cond:
+            self.num_active = max(1, min(num_active, len(self.conns)))
+            self.credit_cond.notify()
+
+    def set_buffer_length(self, buffer_length):
+        with self.credit_cond:
+            for conn in self.conns:
+                self.credits[conn] += buffer_length - self.buffer_length
+            self.buffer_length = buffer_length
+            self.credit_cond.notify()
+
+    def stats(self, reset=False):
+        stats = self.traffic.snapshot()
+        stats['queues'] = {'input': self.input_queue.qsize(), 'output': self.output_queue.qsize()}
+        if reset:
+            self.traffic.reset()
+        return stats
 
     def start(self):
+        self.threads.append(threading.Thread(target=self._generator))
         self.threads.append(threading.Thread(target=self._sender))
         for i in range(self.num_receivers):
             self.threads.append(threading.Thread(target=self._receiver, args=(i,)))
         for thread in self.threads:
             thread.start()
 
+    def _generator(self):
+        # prepare work items apart from the sender
+        print('start generator')
+        while not self.shutdown_flag:
+            data = next(self.send_generator)
+            t = time.time()
+            while not self.shutdown_flag:
+                try:
+                    self.input_queue.put(data, timeout=0.3)
+                    break
+                except queue.Full:
+                    pass
+            self.traffic.observe(('time', 'input_blocked'), time.time() - t)
+        print('finished generator')
+
+    def _acquire_credit(self):
+        # wait until any worker grants credit, and take one from the most idle worker
+        with self.credit_cond:
+            while not self.shutdown_flag:
+                conn = max(self.conns[:self.num_active], key=self.credits.get)
+                if self.credits[conn] > 0:
+                    self.credits[conn] -= 1
+                    return conn
+                self.credit_cond.wait()
+        return None
+
+    def _grant_credit(self, conn, cnt):
+        with self.credit_cond:
+            self.credits[conn] += cnt
+            self.credit_cond.notify()
+
     def _sender(self):
         print('start sender')
         while not self.shutdown_flag:
-            total_send_cnt = 0
-            for conn, cnt in self.send_cnt.items():
-                if cnt < self.buffer_length:
-                    conn.send(next(self.send_generator))
-                    self.lock.acquire()
-                    self.send_cnt[conn] += 1
-                    self.lock.release()
-                    total_send_cnt += 1
-            if total_send_cnt == 0:
-                time.sleep(0.01)
+            conn = self._acquire_credit()
+            while not self.shutdown_flag:
+                try:
+                    data = self.input_queue.get(timeout=0.3)
+                    t = time.time()
+                    buf = ForkingPickler.dumps(data)
+                    self.traffic.observe(('time', 'dumps'), time.time() - t)
+                    conn.send_bytes(buf)
+                    self.traffic.record('send', ['all', 'conn %d' % self.conns.index(conn)], len(buf))
+                    break
+                except queue.Empty:
+                    pass
         print('finished sender')
 
     def _receiver(self, index):
         print('start receiver %d' % index)
         conns = [conn for i, conn in enumerate(self.conns) if i % self.num_receivers == index]
         while not self.shutdown_flag:
-            tmp_conns = mp.connection.wait(conns)
+            tmp_conns = mp.connection.wait(conns, timeout=0.3)  # inactive batchers send nothing
             for conn in tmp_conns:
-                data, cnt = conn.recv()
+                buf = conn.recv_bytes()
+                t = time.time()
+                data, cnt = pickle.loads(buf)
+                self.traffic.observe(('time', 'loads'), time.time() - t)
+                self.traffic.record('recv', ['all', 'conn %d' % self.conns.index(conn)], len(buf))
                 if self.postprocess is not None:
                     data = self.postprocess(data)
+                self.traffic.observe(('depth', 'output'), self.output_queue.qsize())
+                t = time.time()
                 while not self.shutdown_flag:
                     try:
                         self.output_queue.put(data, timeout=0.3)
-                        self.lock.acquire()
-                        self.send_cnt[conn] -= cnt
-                        self.lock.release()
+                        self._grant_credit(conn, cnt)
                         break
                     except queue.Full:
                         pass
+                self.traffic.observe(('time', 'output_blocked'), time.time() - t)
         print('finished receiver %d' % index)
 
 
@@ -207,6 +438,7 @@ class QueueCommunicator:
         self.input_queue = queue.Queue(maxsize=256)
         self.output_queue = queue.Queue(maxsize=256)
         self.conns, self.conn_ids = {}, 0
+        self.traffic = TrafficStats()
         for conn in conns:
             self.add(conn)
         self.shutdown_flag = False
@@ -225,43 +457,103 @@ class QueueCommunicator:
     def recv(self):
         return self.input_queue.get()
 
-    def send(self, conn, send_data):
-        self.output_queue.put((conn, send_data))
+    def send(self, conn, send_data, command=None):
+        # command of the request is given to label the reply in stats
+        self.traffic.observe(('depth', 'output'), self.output_queue.qsize())
+        t = time.time()
+        self.output_queue.put((conn, send_data, command))
+        self.traffic.observe(('time', 'output_blocked'), time.time() - t)
 
     def add(self, conn):
         self.conns[conn] = self.conn_ids
         self.conn_ids += 1
 
+    def saved_bytes(self):
+        # bytes saved by wire compression over all connections
+        return sum(sum(getattr(conn, 'saved_bytes', {}).values()) for conn in list(self.conns))
+
+    def stats(self, reset=False):
+        # traffic per connection and command type, queue depths and time spent
+        stats = self.traffic.snapshot()
+        stats['queues'] = {'input': self.input_queue.qsize(), 'output': self.output_queue.qsize()}
+        if reset:
+            self.traffic.reset()
+        return stats
+
     def disconnect(self, conn):
         print('disconnected')
         self.conns.pop(conn, None)
 
+    def _labels(self, conn, command):
+        return ['all', 'conn %d' % self.conns.get(conn, -1), 'command %s' % command]
+
+    def _dumps(self, conn, send_data):
+        # multiprocessing connections can pass shared objects like tensors
+        dumps = pickle.dumps if isinstance(conn, PickledConnection) else ForkingPickler.dumps
+        t = time.time()
+        buf = dumps(send_data)
+        self.traffic.observe(('time', 'dumps'), time.time() - t)
+        return buf
+
+    def _loads(self, buf):
+        t = time.time()
+        recv_data = pickle.loads(buf)
+        self.traffic.observe(('time', 'loads'), time.time() - t)
+        return recv_data
+
     def _send_thread(self):
         while not self.shutdown_flag:
             try:
-                conn, send_data = self.output_queue.get(timeout=0.3)
+                conn, send_data, command = self.output_queue.get(timeout=0.3)
             except queue.Empty:
                 continue
-            try:
-                conn.send(send_data)
-            except BrokenPipeError:
-                self.disconnect(conn)
+            # drain queued messages and group them by connection
+            send_map = {conn: [(send_data, command)]}
+            while True:
+                try:
+                    conn, send_data, command = self.output_queue.get_nowait()
+                except queue.Empty:
+                    break
+                send_map.setdefault(conn, []).append((send_data, command))
+            for conn, send_list in send_map.items():
+                bufs = [self._dumps(conn, send_data) for send_data, _ in send_list]
+                try:
+                    if isinstance(conn, PickledConnection):
+                        conn.send_bytes_many(bufs)
+                    else:
+                        for buf in bufs:
+                            conn.send_bytes(buf)
+                except (BrokenPipeError, ConnectionResetError):
+                    self.disconnect(conn)
+                    continue
+                for buf, (_, command) in zip(bufs, send_list):
+                    self.traffic.record('send', self._labels(conn, command), len(buf))
 
     def _recv_thread(self):
         while not self.shutdown_flag:
             conn_list, _, _ = select.select(self.conns, [], [], 0.3)
             for conn in conn_list:
-                try:
-                    recv_data = conn.recv()
-                except ConnectionResetError:
-                    self.disconnect(conn)
-                    continue
-                except EOFError:
-                    self.disconnect(conn)
-                    continue
-                while not self.shutdown_flag:
+                while True:
                     try:
-                        self.input_queue.put((conn, recv_data), timeout=0.3)
+                        buf = conn.recv_bytes()
+                    except ConnectionResetError:
+                        self.disconnect(conn)
+                        break
+                    except EOFError:
+                        self.disconnect(conn)
+                        break
+                    recv_data = self._loads(buf)
+                    command = recv_data[0] if isinstance(recv_data, tuple) else None
+                    self.traffic.record('recv', self._labels(conn, command), len(buf))
+                    self.traffic.observe(('depth', 'input'), self.input_queue.qsize())
+                    t = time.time()
+                    while not self.shutdown_flag:
+                        try:
+                            self.input_queue.put((conn, recv_data), timeout=0.3)
+                            break
+                        except queue.Full:
+                            pass
+                    self.traffic.observe(('time', 'input_blocked'), time.time() - t)
+                    # split out coalesced messages already read ahead
+                    if not (isinstance(conn, PickledConnection) and conn.buffered()):
                         break
-                    except queue.Full:
-                        pass
@@ -0,0 +1,436 @@
+# Copyright (c) 2020 DeNA Co., Ltd.
+# Licensed under The MIT License [see LICENSE for details]
+
+# replay buffer of generated episodes
+
+import os
+import mmap
+import glob
+import pickle
+import time
+import multiprocessing as mp
+from collections import deque
+
+import numpy as np
+
+
+def shared_array(size, dtype):
+    # anonymous shared mapping is inherited by forked processes
+    dtype = np.dtype(dtype)
+    return np.frombuffer(mmap.mmap(-1, max(1, size * dtype.itemsize)), dtype=dtype, count=size)
+
+
+class SumTree:
+    # binary tree whose nodes hold the sum of priorities of their children
+    # nodes are in shared memory so that forked processes can sample from it
+    def __init__(self, capacity):
+        self.capacity = 1 << max(0, (capacity - 1).bit_length())
+        self.tree = shared_array(2 * self.capacity, np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, indices):
+        return self.tree[indices + self.capacity]
+
+    def update(self, indices, priorities):
+        nodes = np.asarray(indices, dtype=np.int64) + self.capacity
+        if len(nodes) == 0:
+            return
+        self.tree[nodes] = priorities
+        while nodes[0] > 1:
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        # leaves where cumulative sums of priorities reach the values
+        nodes = np.ones(len(values), dtype=np.int64)
+        while len(nodes) > 0 and nodes[0] < self.capacity:
+            left = self.tree[2 * nodes]
+            right = values >= left
+            values = values - left * right
+            nodes = 2 * nodes + right
+        return nodes - self.capacity
+
+
+class ReplayBuffer:
+    # episodes are written by threads in one process and read by forked processes without locks
+    # the lock is shared with forked trainer processes updating priorities or saving episodes
+    # each record in the ring buffer consists of block offsets, pickled args and outcome, and compressed blocks
+    # with disk tier, old records are moved from memory to segment files instead of evicted
+    def __init__(self, maximum_episodes, maximum_bytes, priority_exponent=None, priority_correction=0,
+                 disk_path=None, maximum_disk_bytes=0, segment_bytes=256 << 20):
+        self.maximum_episodes = maximum_episodes
+        self.maximum_bytes = maximum_bytes
+        self.buf = mmap.mmap(-1, maximum_bytes)
+        self.lock = mp.Lock()
+
+        self.disk_path = disk_path if maximum_disk_bytes > 0 else None
+        self.maximum_disk_bytes = maximum_disk_bytes
+        self.segment_bytes = segment_bytes
+        self.segment_maps = {}  # segment files mapped in each process
+        if self.disk_path is not None:
+            os.makedirs(self.disk_path, exist_ok=True)
+            for path in glob.glob(os.path.join(self.disk_path, '*.seg')):
+                os.remove(path)
+
+        # prioritized sampling when priority exponent is given
+        self.priorities = SumTree(maximum_episodes) if priority_exponent is not None else None
+        self.priority_exponent = priority_exponent
+        self.priority_correction = priority_correction
+        self.max_priority = shared_array(1, np.float64)
+        self.max_priority[0] = 1.0
+
+        # serial numbers of the oldest and the next episodes, and the oldest segment id
+        self.state = shared_array(3, np.int64)
+        # metadata of stored episodes in ring buffers
+        # version is odd while the record is moved to disk
+        self.serials = shared_array(maximum_episodes, np.int64)
+        self.versions = shared_array(maximum_episodes, np.int64)
+        self.segments = shared_array(maximum_episodes, np.int64)  # -1 means memory
+        self.steps = shared_array(maximum_episodes, np.int64)
+        self.offsets = shared_array(maximum_episodes, np.int64)
+        self.num_blocks = shared_array(maximum_episodes, np.int64)
+        self.info_sizes = shared_array(maximum_episodes, np.int64)
+        self.record_sizes = shared_array(maximum_episodes, np.int64)
+        self.serials[:] = -1
+        # used bytes, serial number of the oldest episode in memory and bytes on disk, copied for other processes
+        self.usage = shared_array(3, np.int64)
+        # number of episodes ever given including ones before saved, to know which recorded episodes are used
+        self.num_appended = shared_array(1, np.int64)
+
+        # only used by the writer
+        self.write_pos = 0
+        self.used_bytes = 0
+        self.memory_head = 0  # serial number of the oldest episode in memory
+        self.disk_segments = deque()  # segment id, size and serial number of the first episode
+        self.disk_write_pos = 0
+        self.next_segment_id = 0
+
+    def __len__(self):
+        return int(self.state[1] - self.state[0])
+
+    def stats(self):
+        with self.lock:
+            return {
+                'episodes': len(self), 'evicted_episodes': int(self.state[0]),
+                'used_bytes': int(self.usage[0]), 'allocated_bytes': self.maximum_bytes,
+                'disk_episodes': int(self.usage[1] - self.state[0]), 'disk_bytes': int(self.usage[2]),
+            }
+
+    def _update_usage(self):
+        self.usage[:] = self.used_bytes, self.memory_head, sum(size for _, size, _ in self.disk_segments)
+
+    def _segment_path(self, segment_id):
+        return os.path.join(self.disk_path, '%d.seg' % segment_id)
+
+    def _buffer(self, segment_id):
+        # returns None when the segment has been removed
+        if segment_id < 0:
+            return self.buf
+        if segment_id not in self.segment_maps:
+            for sid in [sid for sid in list(self.segment_maps) if sid < self.state[2]]:
+                self.segment_maps.pop(sid).close()
+            try:
+                with open(self._segment_path(segment_id), 'rb') as f:
+                    self.segment_maps[segment_id] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                return None
+        return self.segment_maps[segment_id]
+
+    def _evict(self):
+        pos = self.state[0] % self.maximum_episodes
+        if self.segments[pos] < 0:
+            self.used_bytes -= int(self.record_sizes[pos])
+        self.state[0] += 1
+        self.memory_head = max(self.memory_head, int(self.state[0]))
+        if self.priorities is not None:
+            self.priorities.update([pos], [0])
+
+    def _remove_segment(self):
+        segment_id, _, _ = self.disk_segments.popleft()
+        # episodes in the segment are evicted before removing the file
+        next_serial = self.disk_segments[0][2] if len(self.disk_segments) > 0 else self.memory_head
+        while self.state[0] < next_serial:
+            self._evict()
+        self.state[2] = segment_id + 1
+        if segment_id in self.segment_maps:
+            self.segment_maps.pop(segment_id).close()
+        os.remove(self._segment_path(segment_id))
+
+    def _allocate_disk(self, size):
+        if len(self.disk_segments) == 0 or self.disk_write_pos + size > self.disk_segments[-1][1]:
+            segment_size = max(size, self.segment_bytes)
+            while len(self.disk_segments) > 0 and \
+                    sum(s for _, s, _ in self.disk_segments) + segment_size > self.maximum_disk_bytes:
+                self._remove_segment()
+            segment_id = self.next_segment_id
+            self.next_segment_id += 1
+            with open(self._segment_path(segment_id), 'w+b') as f:
+                f.truncate(segment_size)
+                self.segment_maps[segment_id] = mmap.mmap(f.fileno(), segment_size)
+            self.disk_segments.append((segment_id, segment_size, self.memory_head))
+            self.disk_write_pos = 0
+        offset = self.disk_write_pos
+        self.disk_write_pos += size
+        return self.disk_segments[-1][0], offset
+
+    def _release_memory(self):
+        # move the oldest record in memory to disk, or evict it without disk tier
+        if self.disk_path is None:
+            self._evict()
+            return
+        pos = self.memory_head % self.maximum_episodes
+        offset, size = int(self.offsets[pos]), int(self.record_sizes[pos])
+        segment_id, disk_offset = self._allocate_disk(size)
+        self.segment_maps[segment_id][disk_offset:disk_offset + size] = self.buf[offset:offset + size]
+        self.versions[pos] += 1
+        self.segments[pos], self.offsets[pos] = segment_id, disk_offset
+        self.versions[pos] += 1
+        self.used_bytes -= size
+        self.memory_head += 1
+
+    def _overlaps_memory_head(self, start, end):
+        pos = self.memory_head % self.maximum_episodes
+        return self.offsets[pos] < end and start < self.offsets[pos] + self.record_sizes[pos]
+
+    def _append(self, args, outcome, steps, data, sizes):
+        # data is concatenated blocks of an episode
+        block_offset = np.cumsum([0] + list(sizes), dtype=np.int64)
+        info = pickle.dumps((args, outcome))
+        header_size = block_offset.nbytes + len(info)
+        size = header_size + len(data)
+        if size > self.maximum_bytes:
+            print('too large episode for replay buffer (%d bytes)' % size)
+            return
+
+        # records are always evicted or moved before overwritten so that readers can detect it
+        if len(self) >= self.maximum_episodes:
+            self._evict()
+        if self.write_pos + size > self.maximum_bytes:
+            # records in memory after the write position are the oldest ones
+            while self.state[1] > self.memory_head and self.offsets[self.memory_head % self.maximum_episodes] >= self.write_pos:
+                self._release_memory()
+            self.write_pos = 0
+        while self.state[1] > self.memory_head and self._overlaps_memory_head(self.write_pos, self.write_pos + size):
+            self._release_memory()
+
+        serial, offset = int(self.state[1]), self.write_pos
+        pos = serial % self.maximum_episodes
+        self.serials[pos] = -1
+        self.segments[pos] = -1
+        self.steps[pos], self.offsets[pos], self.num_blocks[pos] = steps, offset, len(sizes)
+        self.info_sizes[pos], self.record_sizes[pos] = len(info), size
+        self.buf[offset:offset + block_offset.nbytes] = block_offset.tobytes()
+        self.buf[offset + block_offset.nbytes:offset + header_size] = info
+        self.buf[offset + header_size:offset + size] = memoryview(data)
+        self.serials[pos] = serial
+        self.state[1] = serial + 1
+        self.write_pos += size
+        self.used_bytes += size
+        if self.priorities is not None:
+            # new episodes are sampled at least once with high probability
+            self.priorities.update([pos], [self.max_priority[0]])
+
+    def extend(self, episodes):
+        with self.lock:
+            for ep in episodes:
+                self._append(ep['args'], ep['outcome'], ep['steps'], b''.join(ep['moment']), [len(ms) for ms in ep['moment']])
+            self.num_appended[0] += len(episodes)
+            self._update_usage()
+
+    def update_priorities(self, serials, errors):
+        # priorities of episodes from errors on training, ignoring evicted ones
+        with self.lock:
+            positions = serials % self.maximum_episodes
+            valid = (self.serials[positions] == serials) & (serials >= self.state[0])
+            if not valid.any():
+                return
+            priorities = (errors[valid] + 1e-3) ** self.priority_exponent
+            self.priorities.update(positions[valid], priorities)
+            self.max_priority[0] = max(self.max_priority[0], priorities.max())
+
+    def _valid(self, serial, pos, version):
+        return self.serials[pos] == serial and self.state[0] <= serial and self.versions[pos] == version
+
+    def _stored(self, serial, pos):
+        return self.serials[pos] == serial and self.state[0] <= serial
+
+    def _read(self, serial, pos, st_block=0, ed_block=None):
+        # returns None when the record is moved or overwritten while reading
+        version = self.versions[pos]
+        if version % 2 == 1:
+            return None
+        offset, num_blocks, info_size = int(self.offsets[pos]), int(self.num_blocks[pos]), int(self.info_sizes[pos])
+        buf = self._buffer(int(self.segments[pos]))
+        if buf is None:
+            return None
+        header_size = (num_blocks + 1) * 8 + info_size
+        try:
+            header = buf[offset:offset + header_size]
+            if not self._valid(serial, pos, version):
+                return None
+            block_offset = np.frombuffer(header, dtype=np.int64, count=num_blocks + 1)
+            args, outcome = pickle.loads(header[(num_blocks + 1) * 8:])
+            data_offset = offset + header_size
+            moments = [
+                buf[data_offset + block_offset[i]:data_offset + block_offset[i + 1]]
+                for i in range(st_block, num_blocks if ed_block is None else ed_block)
+            ]
+        except ValueError:
+            return None  # segment closed by the writer thread in the same process
+        if not self._valid(serial, pos, version):
+            return None
+        return {'args': args, 'outcome': outcome, 'moment': moments}
+
+    def _sample_serials(self, head, tail, size):
+        # candidates are chosen by priorities, then accepted giving priority to recent ones
+        count = tail - head
+        if self.priorities is None:
+            candidates = head + np.random.randint(count, size=size * 2)
+            weights = np.ones(len(candidates))
+        else:
+            total = self.priorities.total()
+            positions = np.minimum(self.priorities.find(np.random.random(size * 2) * total), self.maximum_episodes - 1)
+            candidates = self.serials[positions]
+            probs = self.priorities.get(positions) / max(total, 1e-12)
+            # tree might be updated while sampling
+            valid = (candidates >= head) & (candidates < tail) & (probs > 0)
+            candidates, probs = candidates[valid], probs[valid]
+            # importance sampling weights before normalization
+            weights = (count * probs) ** -self.priority_correction
+        accept_rate = 1 - (tail - 1 - candidates) / self.maximum_episodes
+        accepted = np.random.random(len(candidates)) < accept_rate
+        return candidates[accepted][:size], weights[accepted][:size]
+
+    def sample(self, batch_size, forward_steps, compress_steps):
+        # select episodes giving priority to recent ones, and start turns of them
+        # this can be called from any process sharing the buffer
+        episodes = []
+        while len(episodes) < batch_size:
+            head, tail = int(self.state[0]), int(self.state[1])
+            if tail == head:
+                time.sleep(0.1)
+                continue
+            serials, weights = self._sample_serials(head, tail, batch_size - len(episodes))
+            positions = serials % self.maximum_episodes
+
+            steps = self.steps[positions]
+            turn_candidates = 1 + np.maximum(0, steps - forward_steps)  # change start turn by sequence length
+            sts = (np.random.random(len(serials)) * turn_candidates).astype(np.int64)
+            eds = np.minimum(sts + forward_steps, steps)
+            st_blocks = sts // compress_steps
+            ed_blocks = (eds - 1) // compress_steps + 1
+
+            for serial, weight, pos, st, ed, total, st_block, ed_block in \
+                    zip(serials, weights, positions, sts, eds, steps, st_blocks, ed_blocks):
+                ep = self._read(serial, pos, st_block, ed_block)
+                if ep is None:
+                    continue
+                ep.update({
+                    'id': int(serial), 'weight': float(weight), 'base': int(st_block) * compress_steps,
+                    'start': int(st), 'end': int(ed), 'total': int(total)
+                })
+                episodes.append(ep)
+        return episodes
+
+    def save(self, path):
+        # compressed blocks are concatenated in one file to be read through memory map
+        # only metadata is copied under the lock, and records evicted while saving are skipped
+        with self.lock:
+            serials = np.arange(self.state[0], self.state[1])
+            positions = serials % self.maximum_episodes
+            steps = self.steps[positions].copy()
+            num_appended = int(self.num_appended[0])
+        block_offset, episode_block, saved_steps, infos = [0], [0], [], []
+        with open(path + '.bin', 'wb') as f:
+            for serial, pos, st in zip(serials, positions, steps):
+                ep = self._read(serial, pos)
+                while ep is None and self._stored(serial, pos):
+                    time.sleep(0)  # the record is being moved to disk
+                    ep = self._read(serial, pos)
+                if ep is None:
+                    continue
+                for ms in ep['moment']:
+                    f.write(ms)
+                    block_offset.append(block_offset[-1] + len(ms))
+                episode_block.append(len(block_offset) - 1)
+                saved_steps.append(st)
+                infos.append((ep['args'], ep['outcome']))
+        np.savez(
+            path + '.npz',
+            block_offset=np.array(block_offset, dtype=np.int64),
+            episode_block=np.array(episode_block, dtype=np.int64),
+            steps=np.array(saved_steps, dtype=np.int64),
+            num_appended=np.array(num_appended, dtype=np.int64),
+        )
+        with open(path + '.pkl', 'wb') as f:
+            pickle.dump(infos, f)
+
+    def load(self, path):
+        index = np.load(path + '.npz')
+        block_offset, episode_block, steps = index['block_offset'], index['episode_block'], index['steps']
+        data = np.memmap(path + '.bin', dtype=np.uint8, mode='r') if block_offset[-1] > 0 else np.zeros(0, dtype=np.uint8)
+        with open(path + '.pkl', 'rb') as f:
+            infos = pickle.load(f)
+        with self.lock:
+            for i, (args, outcome) in enumerate(infos):
+                offsets = block_offset[episode_block[i]:episode_block[i + 1] + 1]
+                self._append(args, outcome, int(steps[i]), data[offsets[0]:offsets[-1]], np.diff(offsets))
+            self.num_appended[0] += int(index['num_appended'])
+            self._update_usage()
+
+
+class EpisodeWriter:
+    # appends episodes to sharded files, and their offsets, sizes and steps to index files
+    # a record is read only after its index entry is written
+    def __init__(self, path, shard_episodes):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.shard_episodes = shard_episodes
+        # new shards follow existing ones not to overwrite recorded episodes
+        self.shard_id = len(glob.glob(os.path.join(path, '*.idx')))
+        self.data_file, self.index_file = None, None
+        self.entries = []
+
+    def _flush(self):
+        self.data_file.flush()
+        self.index_file.write(np.array(self.entries, dtype=np.int64).tobytes())
+        self.index_file.flush()
+        self.entries = []
+
+    def _open(self):
+        if self.data_file is not None:
+            self.close()
+            self.shard_id += 1
+        name = os.path.join(self.path, '%06d' % self.shard_id)
+        self.data_file, self.index_file = open(name + '.bin', 'ab'), open(name + '.idx', 'ab')
+        self.offset, self.shard_count = self.data_file.tell(), 0
+
+    def write(self, episodes):
+        for ep in episodes:
+            if self.data_file is None or self.shard_count >= self.shard_episodes:
+                self._open()
+            buf = pickle.dumps(ep)
+            self.data_file.write(buf)
+            self.entries.append((self.offset, len(buf), ep['steps']))
+            self.offset += len(buf)
+            self.shard_count += 1
+        if self.data_file is not None:
+            self._flush()
+
+    def close(self):
+        if self.data_file is not None:
+            self._flush()
+            self.data_file.close()
+            self.index_file.close()
+
+
+def read_episodes(path):
+    # streams recorded episodes in order
+    for index_path in sorted(glob.glob(os.path.join(path, '*.idx'))):
+        index = np.fromfile(index_path, dtype=np.int64).reshape(-1, 3)
+        with open(index_path[:-len('.idx')] + '.bin', 'rb') as f:
+            for offset, size, _ in index:
+                f.seek(offset)
+                yield pickle.loads(f.read(size))
@@ -15,30 +15,116 @@ import threading
 import random
 import bz2
 import pickle
-from collections import deque
+import queue
+import shutil
+import functools
+import itertools
+import tempfile
+import multiprocessing as mp
+from collections import deque, OrderedDict
 
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.distributions as dist
+import torch.distributed as distributed
 import torch.optim as optim
 
 from .environment import prepare_env, make_env
 from .util import map_r, bimap_r, trimap_r, rotate, type_r
 from .model import to_torch, to_gpu_or_not, RandomModel
 from .model import SimpleConv2DModel as DefaultModel
-from .connection import MultiProcessWorkers
-from .connection import accept_socket_connections
+from .connection import MultiProcessWorkers, Serialized, format_stats
+from .connection import accept_socket_connections, select_compression
 from .worker import Workers
-
-
-def make_batch(episodes, args):
+from .replay import ReplayBuffer, EpisodeWriter, read_episodes, shared_array
+
+
+def decode_block(ms):
+    return pickle.loads(bz2.decompress(ms))
+
+
+class BlockCache:
+    # LRU cache of decoded blocks in a batcher process
+    # memory usage is estimated by the size of decompressed pickle
+    def __init__(self, limit_bytes, counts):
+        self.limit_bytes = limit_bytes
+        self.counts = counts  # hit and miss counts in shared memory
+        self.blocks = OrderedDict()
+        self.total_bytes = 0
+
+    def decode(self, key, ms):
+        if key in self.blocks:
+            self.blocks.move_to_end(key)
+            self.counts[0] += 1
+            return self.blocks[key][0]
+        self.counts[1] += 1
+        buf = bz2.decompress(ms)
+        block = pickle.loads(buf)
+        if len(buf) <= self.limit_bytes:
+            self.blocks[key] = block, len(buf)
+            self.total_bytes += len(buf)
+            while self.total_bytes > self.limit_bytes:
+                _, (_, size) = self.blocks.popitem(last=False)
+                self.total_bytes -= size
+        return block
+
+
+class BatchSlot:
+    # tensors of a batch in one shared memory buffer recycled between a batcher and the trainer
+    # the first byte is set when the trainer has finished using the batch
+    def __init__(self, batch):
+        leaves = []
+        self.structure = map_r(batch, leaves.append)
+        self.specs = [(t.shape, t.dtype) for t in leaves]
+        size = 8 + sum((t.numel() * t.element_size() + 7) // 8 * 8 for t in leaves)
+        self.buffer = torch.zeros(size, dtype=torch.uint8).share_memory_()
+        self.tensors = self._views()
+        bimap_r(self.tensors, batch, lambda d, t: d.copy_(t))
+
+    def _views(self):
+        specs, offset = iter(self.specs), 8
+
+        def view(_):
+            nonlocal offset
+            shape, dtype = next(specs)
+            size = shape.numel() * torch.empty(0, dtype=dtype).element_size()
+            t = self.buffer[offset:offset + size].view(dtype).view(shape)
+            offset += (size + 7) // 8 * 8
+            return t
+
+        return map_r(self.structure, view)
+
+    def __getstate__(self):
+        # only the buffer is shared, and views are made again in the receiver
+        return {'structure': self.structure, 'specs': self.specs, 'buffer': self.buffer}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.tensors = self._views()
+
+    def fill(self, batch):
+        # returns False if the slot is still used or the batch has other shapes
+        leaves = []
+        map_r(batch, leaves.append)
+        if self.buffer[0] == 0 or self.specs != [(t.shape, t.dtype) for t in leaves]:
+            return False
+        self.buffer[0] = 0
+        bimap_r(self.tensors, batch, lambda d, t: d.copy_(t))
+        return True
+
+    def release(self):
+        self.buffer[0] = 1
+
+
+def make_batch(episodes, args, block_cache=None):
     """Making training batch
 
     Args:
         episodes (Iterable): list of episodes
         args (dict): training configuration
+        block_cache (BlockCache): optional cache of decoded blocks
 
     Returns:
         dict: PyTorch input and target tensors
@@ -48,82 +134,68 @@ def make_batch(episodes, args):
         (B is batch size, T is time length, P is player count)
     """
 
-    obss, datum = [], []
-
+    batch_size, steps = len(episodes), args['forward_steps']
+    moments_list = []
     for ep in episodes:
-        # target player and turn index
-        moments_ = sum([pickle.loads(bz2.decompress(ms)) for ms in ep['moment']], [])
-        moments = moments_[ep['start'] - ep['base']:ep['end'] - ep['base']]
-        players = list(moments[0]['observation'].keys())
+        if block_cache is not None:
+            # key of each block is episode id and block index
+            first_block = ep['base'] // args['compress_steps']
+            blocks = [block_cache.decode((ep['id'], first_block + i), ms) for i, ms in enumerate(ep['moment'])]
+        else:
+            blocks = [decode_block(ms) for ms in ep['moment']]
+        moments_ = sum(blocks, [])
+        moments_list.append(moments_[ep['start'] - ep['base']:ep['end'] - ep['base']])
+
+    # allocate output arrays once, initialized with padding values
+    m0 = moments_list[0][0]
+    players = list(m0['observation'].keys())
+    obs_zeros = map_r(m0['observation'][m0['turn']], lambda o: np.zeros_like(o))  # template for padding
+    obs_players = len(players) if args['observation'] else 1
+    obs = map_r(obs_zeros, lambda o: np.zeros((batch_size, steps, obs_players) + o.shape, dtype=o.dtype))
+    tmsk = np.zeros((batch_size, steps, len(players)), dtype=np.float32)
+    pmsk = np.full((batch_size, steps) + m0['pmask'].shape, 1e32, dtype=m0['pmask'].dtype)
+    vmsk = np.zeros((batch_size, steps, len(players)), dtype=np.float32)
+    act = np.zeros((batch_size, steps, 1), dtype=np.int64)
+    p = np.zeros((batch_size, steps) + m0['policy'].shape, dtype=m0['policy'].dtype)
+    v = np.zeros((batch_size, steps, len(players)), dtype=np.float32)
+    rew = np.zeros((batch_size, steps, len(players)), dtype=np.float32)
+    ret = np.zeros((batch_size, steps, len(players)), dtype=np.float32)
+    oc = np.zeros((batch_size, 1, len(players)), dtype=np.float32)
+    progress = np.ones((batch_size, steps), dtype=np.float32)
+
+    for b, (ep, moments) in enumerate(zip(episodes, moments_list)):
+        n = len(moments)
+
+        def fill(buf, o):
+            buf[b, :n] = o
 
-        obs_zeros = map_r(moments[0]['observation'][moments[0]['turn']], lambda o: np.zeros_like(o))  # template for padding
         if args['observation']:
             # replace None with zeros
-            obs = [[(lambda x: (x if x is not None else obs_zeros))(m['observation'][pl]) for pl in players] for m in moments]
+            ob = [[(lambda x: (x if x is not None else obs_zeros))(m['observation'][pl]) for pl in players] for m in moments]
         else:
-            obs = [[m['observation'][m['turn']]] for m in moments]
-        obs = rotate(obs)  # (T, P, ..., ...) -> (P, ..., T, ...)
-        obs = rotate(obs)  # (P, ..., T, ...) -> (..., T, P, ...)
-        obs = bimap_r(obs_zeros, obs, lambda _, o: np.array(o))
-
-        # datum that is not changed by training configuration
-        v = np.array(
-            [[m['value'][player] or 0 for player in players] for m in moments],
-            dtype=np.float32
-        ).reshape(-1, len(players))
-        rew = np.array(
-            [[m['reward'][player] or 0 for player in players] for m in moments],
-            dtype=np.float32
-        ).reshape(-1, len(players))
-        ret = np.array(
-            [[m['return'][player] for player in players] for m in moments],
-            dtype=np.float32
-        ).reshape(-1, len(players))
-        oc = np.array([ep['outcome'][player] for player in players], dtype=np.float32).reshape(-1, len(players))
-        tmsk = np.array([[pl == m['turn'] for pl in players] for m in moments], dtype=np.float32)
-        pmsk = np.array([m['pmask'] for m in moments])
-        vmsk = np.ones_like(tmsk) if args['observation'] else tmsk
-
-        act = np.array([m['action'] for m in moments]).reshape(-1, 1)
-        p = np.array([m['policy'] for m in moments])
-        progress = np.arange(ep['start'], ep['end'], dtype=np.float32) / ep['total']
-
-        # pad each array if step length is short
-        if len(tmsk) < args['forward_steps']:
-            pad_len = args['forward_steps'] - len(tmsk)
-            obs = map_r(obs, lambda o: np.pad(o, [(0, pad_len)] + [(0, 0)] * (len(o.shape) - 1), 'constant', constant_values=0))
-            v = np.concatenate([v, np.tile(oc, [pad_len, 1])])
-            rew = np.pad(rew, [(0, pad_len), (0, 0)], 'constant', constant_values=0)
-            ret = np.pad(ret, [(0, pad_len), (0, 0)], 'constant', constant_values=0)
-            tmsk = np.pad(tmsk, [(0, pad_len), (0, 0)], 'constant', constant_values=0)
-            pmsk = np.pad(pmsk, [(0, pad_len), (0, 0)], 'constant', constant_values=1e32)
-            vmsk = np.pad(vmsk, [(0, pad_len), (0, 0)], 'constant', constant_values=0)
-            act = np.pad(act, [(0, pad_len), (0, 0)], 'constant', constant_values=0)
-            p = np.pad(p, [(0, pad_len), (0, 0)], 'constant', constant_values=0)
-            progress = np.pad(progress, [(0, pad_len)], 'constant', constant_values=1)
-
-        obss.append(obs)
-        datum.append((tmsk, pmsk, vmsk, act, p, v, rew, ret, oc, progress))
-
-    tmsk, pmsk, vmsk, act, p, v, rew, ret, oc, progress = zip(*datum)
-
-    obs = to_torch(bimap_r(obs_zeros, rotate(obss), lambda _, o: np.array(o)))
-    tmsk = to_torch(np.array(tmsk))
-    pmsk = to_torch(np.array(pmsk))
-    vmsk = to_torch(np.array(vmsk))
-    act = to_torch(np.array(act))
-    p = to_torch(np.array(p))
-    v = to_torch(np.array(v))
-    rew = to_torch(np.array(rew))
-    ret = to_torch(np.array(ret))
-    oc = to_torch(np.array(oc))
-    progress = to_torch(np.array(progress))
+            ob = [[m['observation'][m['turn']]] for m in moments]
+        ob = rotate(rotate(ob))  # (T, P, ..., ...) -> (..., T, P, ...)
+        bimap_r(obs, ob, fill)
+
+        tmsk[b, :n] = [[pl == m['turn'] for pl in players] for m in moments]
+        pmsk[b, :n] = [m['pmask'] for m in moments]
+        vmsk[b, :n] = 1 if args['observation'] else tmsk[b, :n]
+        act[b, :n, 0] = [m['action'] for m in moments]
+        p[b, :n] = [m['policy'] for m in moments]
+
+        # value after the end of the episode is the outcome
+        oc[b, 0] = [ep['outcome'][pl] for pl in players]
+        v[b, :n] = [[np.reshape(m['value'][pl], ()) if m['value'][pl] is not None else 0 for pl in players] for m in moments]
+        v[b, n:] = oc[b]
+        rew[b, :n] = [[m['reward'][pl] or 0 for pl in players] for m in moments]
+        ret[b, :n] = [[m['return'][pl] for pl in players] for m in moments]
+        progress[b, :n] = np.arange(ep['start'], ep['end'], dtype=np.float32) / ep['total']
 
     return {
-        'observation': obs, 'tmask': tmsk, 'pmask': pmsk, 'vmask': vmsk,
-        'action': act, 'policy': p, 'value': v,
-        'reward': rew, 'return': ret, 'outcome': oc,
-        'progress': progress,
+        'observation': to_torch(obs), 'tmask': to_torch(tmsk), 'pmask': to_torch(pmsk), 'vmask': to_torch(vmsk),
+        'action': to_torch(act), 'policy': to_torch(p), 'value': to_torch(v),
+        'reward': to_torch(rew), 'return': to_torch(ret), 'outcome': to_torch(oc),
+        'progress': to_torch(progress),
     }
 
 
@@ -188,23 +260,31 @@ def forward_prediction(model, hidden, batch, obs_mode):
 
 def compose_losses(policies, values, returns, log_selected_policies, \
                    advantages, value_targets, return_targets, \
-                   tmasks, vmasks, progress, args):
+                   tmasks, vmasks, progress, args, weights=None):
     """Caluculate loss value
 
     Returns:
-        tuple: losses and statistic values and the number of training data
+        tuple: losses and statistic values, the number of training data (as tensor) and errors of each sample
     """
 
     losses = {}
-    dcnt = tmasks.sum().item()
+    dcnt = tmasks.sum()  # converted to number by caller not to break compiled graph
+    weights = weights if weights is not None else 1  # importance sampling weights of samples
 
     turn_advantages = advantages.mul(tmasks).sum(-1, keepdim=True)
 
-    losses['p'] = (-log_selected_policies * turn_advantages).sum()
+    losses['p'] = (-log_selected_policies * turn_advantages).mul(weights).sum()
     if values is not None:
-        losses['v'] = ((values - value_targets) ** 2).mul(vmasks).sum() / 2
+        losses['v'] = ((values - value_targets) ** 2).mul(vmasks).mul(weights).sum() / 2
     if returns is not None:
-        losses['r'] = F.smooth_l1_loss(returns, return_targets, reduction='none').mul(vmasks).sum()
+        losses['r'] = F.smooth_l1_loss(returns, return_targets, reduction='none').mul(vmasks).mul(weights).sum()
+
+    # mean absolute error of each sample, used for prioritized replay
+    if values is not None:
+        errors = (values - value_targets).detach().abs().mul(vmasks).sum((1, 2))
+    else:
+        errors = turn_advantages.detach().abs().sum((1, 2))
+    errors = errors / tmasks.sum((1, 2)).clamp(min=1)
 
     entropy = dist.Categorical(logits=policies).entropy().mul(tmasks.sum(-1))
     losses['ent'] = entropy.sum()
@@ -213,7 +293,7 @@ def compose_losses(policies, values, returns, log_selected_policies, \
     entropy_loss = entropy.mul(1 - progress * (1 - args['entropy_regularization_decay'])).sum() * -args['entropy_regularization']
     losses['total'] = base_loss + entropy_loss
 
-    return losses, dcnt
+    return losses, dcnt, errors
 
 
 def vtrace_base(batch, model, hidden, args):
@@ -249,6 +329,20 @@ def vtrace_base(batch, model, hidden, args):
         values_nograd, returns_nograd, clipped_rhos, cs
 
 
+def backward_scan(deltas, decays):
+    # solves x[t] = deltas[t] + decays[t] * x[t + 1] backward along time axis with x[T] = 0
+    # by combining spans doubling in each step, that needs only log(T) steps of tensor operations
+    xs, ds = deltas, decays
+    time_length, span = deltas.size(1), 1
+    while span < time_length:
+        xs_next = torch.cat([xs[:, span:], torch.zeros_like(xs[:, :span])], dim=1)
+        xs = xs + ds * xs_next
+        if span * 2 < time_length:
+            ds = ds * torch.cat([ds[:, span:], torch.zeros_like(ds[:, :span])], dim=1)
+        span *= 2
+    return xs
+
+
 def vtrace(batch, model, hidden, args):
     # IMPALA
     # https://github.com/deepmind/scalable_agent/blob/master/vtrace.py
@@ -257,7 +351,6 @@ def vtrace(batch, model, hidden, args):
         values_nograd, returns_nograd, clipped_rhos, cs = \
         vtrace_base(batch, model, hidden, args)
     outcomes, returns, rewards = batch['outcome'], batch['return'], batch['reward']
-    time_length = batch['vmask'].size(1)
 
     if args['algorithm'] == 'MC':
         # IS with naive advantage
@@ -271,11 +364,7 @@ def vtrace(batch, model, hidden, args):
             deltas_v = clipped_rhos * (values_t_plus_1 - values_nograd)
 
             # compute Vtrace value target recursively
-            vs_minus_v_xs = deque([deltas_v[:, -1]])
-            for i in range(time_length - 2, -1, -1):
-                vs_minus_v_xs.appendleft(deltas_v[:, i] + cs[:, i] * vs_minus_v_xs[0])
-
-            vs_minus_v_xs = torch.stack(tuple(vs_minus_v_xs), dim=1)
+            vs_minus_v_xs = backward_scan(deltas_v, cs)
             vs = vs_minus_v_xs + values_nograd
             vs_t_plus_1 = torch.cat([vs[:, 1:], outcomes], dim=1)
 
@@ -291,11 +380,7 @@ def vtrace(batch, model, hidden, args):
             deltas_r = clipped_rhos * (rewards + args['gamma'] * returns_t_plus_1 - returns_nograd)
 
             # compute Vtrace return target recursively
-            rs_minus_r_xs = deque([deltas_r[:, -1]])
-            for i in range(time_length - 2, -1, -1):
-                rs_minus_r_xs.appendleft(deltas_r[:, i] + args['gamma'] * cs[:, i] * rs_minus_r_xs[0])
-
-            rs_minus_r_xs = torch.stack(tuple(rs_minus_r_xs), dim=1)
+            rs_minus_r_xs = backward_scan(deltas_r, args['gamma'] * cs)
             rs = rs_minus_r_xs + returns_nograd
             rs_t_plus_1 = torch.cat([rs[:, 1:], next_returns], dim=1)
 
@@ -309,11 +394,8 @@ def vtrace(batch, model, hidden, args):
         lmb = args['lambda']
 
         if t_values is not None:
-            lambda_values = deque([outcomes[:, -1]])
-            for i in range(time_length - 2, -1, -1):
-                lambda_values.appendleft((1 - lmb) * values_nograd[:, i + 1] + lmb * lambda_values[0])
-
-            lambda_values = torch.stack(tuple(lambda_values), dim=1)
+            deltas_v = torch.cat([(1 - lmb) * values_nograd[:, 1:], outcomes], dim=1)
+            lambda_values = backward_scan(deltas_v, torch.full_like(deltas_v, lmb))
             value_targets = lambda_values
             value_advantages = lambda_values - values_nograd
         else:
@@ -321,11 +403,8 @@ def vtrace(batch, model, hidden, args):
             value_advantages = 0
 
         if t_returns is not None:
-            lambda_returns = deque([returns[:, -1]])
-            for i in range(time_length - 2, -1, -1):
-                lambda_returns.appendleft(rewards[:, i] + args['gamma'] * ((1 - lmb) * returns_nograd[:, i + 1] + lmb * lambda_returns[0]))
-
-            lambda_returns = torch.stack(tuple(lambda_returns), dim=1)
+            deltas_r = torch.cat([rewards[:, :-1] + args['gamma'] * (1 - lmb) * returns_nograd[:, 1:], returns[:, -1:]], dim=1)
+            lambda_returns = backward_scan(deltas_r, torch.full_like(deltas_r, args['gamma'] * lmb))
             return_targets = lambda_returns
             return_advantages = lambda_returns - returns_nograd
         else:
@@ -337,69 +416,215 @@ def vtrace(batch, model, hidden, args):
 
     return compose_losses(
         t_policies, t_values, t_returns, log_selected_t_policies, advantages, value_targets, return_targets,
-        batch['tmask'], batch['vmask'], batch['progress'], args
+        batch['tmask'], batch['vmask'], batch['progress'], args, batch.get('weight')
     )
 
 
+class CompiledLoss:
+    # loss function compiled with torch.compile, falling back to eager mode if the model cannot be compiled
+    def __init__(self, func):
+        self.func = func
+        self.compiled_func = None
+        if hasattr(torch, 'compile'):
+            self.compiled_func = torch.compile(func)
+        else:
+            print('torch.compile is not available, training in eager mode')
+
+    def __call__(self, batch, model, hidden, args):
+        if self.compiled_func is not None:
+            try:
+                # shallow copy since vtrace replaces some items of batch
+                return self.compiled_func(dict(batch), model, hidden, args)
+            except Exception as e:
+                print('failed to compile training step, training in eager mode: %s' % e)
+                self.compiled_func = None
+        return self.func(batch, model, hidden, args)
+
+
 class Batcher:
     def __init__(self, args, episodes):
         self.args = args
         self.episodes = episodes
         self.shutdown_flag = False
+        # processes for the maximum number of batchers are forked first, and some of them are used
+        num_batchers = max(self.args['num_batchers'], self.args['maximum_batchers'])
+        self.cache_counts = shared_array(2 * num_batchers, np.int64)
+        self.depth_sum, self.depth_cnt = 0, 0
+        self.slots = {}  # batch slots of all batchers received once
+        self.in_use = None
 
         self.workers = MultiProcessWorkers(
-            self._worker, self._selector(), self.args['num_batchers'],
-            buffer_length=3, num_receivers=2
+            self._worker, self._selector(), num_batchers, postprocess=self._receive_slot,
+            buffer_length=self.args['batcher_buffer_length'], num_receivers=self.args['batcher_receivers'],
+            num_active=self.args['num_batchers']
         )
 
     def _selector(self):
+        # batchers select episodes by themselves from the shared replay buffer
         while True:
-            yield [self.select_episode() for _ in range(self.args['batch_size'])]
+            yield self.args['batch_size']
 
     def _worker(self, conn, bid):
         print('started batcher %d' % bid)
+        np.random.seed()  # different sequence in each batcher
+        block_cache = None
+        if self.args['block_cache_mb'] > 0:
+            block_cache = BlockCache(self.args['block_cache_mb'] << 20, self.cache_counts[2 * bid:2 * bid + 2])
+        slots = []  # batches are written into free slots, and new slots are sent only once
         while not self.shutdown_flag:
-            episodes = conn.recv()
-            batch = make_batch(episodes, self.args)
-            conn.send((batch, 1))
+            batch_size = conn.recv()
+            episodes = self.episodes.sample(batch_size, self.args['forward_steps'], self.args['compress_steps'])
+            batch = make_batch(episodes, self.args, block_cache)
+            if self.args['prioritized_replay']:
+                weights = np.array([ep['weight'] for ep in episodes], dtype=np.float32)
+                batch['id'] = torch.LongTensor([ep['id'] for ep in episodes])
+                batch['weight'] = torch.FloatTensor(weights / weights.max()).view(-1, 1, 1)
+            index = next((i for i, slot in enumerate(slots) if slot.fill(batch)), None)
+            if index is not None:
+                conn.send(((bid, index, None), 1))
+                continue
+            index = next((i for i, slot in enumerate(slots) if slot.buffer[0] == 1), len(slots))
+            slot = BatchSlot(batch)
+            slots[index:index + 1] = [slot]  # a free slot of other shapes is replaced
+            conn.send(((bid, index, slot), 1))
         print('finished batcher %d' % bid)
 
     def run(self):
         self.workers.start()
 
-    def select_episode(self):
-        while True:
-            ep_idx = random.randrange(min(len(self.episodes), self.args['maximum_episodes']))
-            accept_rate = 1 - (len(self.episodes) - 1 - ep_idx) / self.args['maximum_episodes']
-            if random.random() < accept_rate:
-                break
-        ep = self.episodes[ep_idx]
-        turn_candidates = 1 + max(0, ep['steps'] - self.args['forward_steps'])  # change start turn by sequence length
-        st = random.randrange(turn_candidates)
-        ed = min(st + self.args['forward_steps'], ep['steps'])
-        st_block = st // self.args['compress_steps']
-        ed_block = (ed - 1) // self.args['compress_steps'] + 1
-        ep_minimum = {
-            'args': ep['args'], 'outcome': ep['outcome'],
-            'moment': ep['moment'][st_block:ed_block],
-            'base': st_block * self.args['compress_steps'],
-            'start': st, 'end': ed, 'total': ep['steps']
-        }
-        return ep_minimum
+    def _receive_slot(self, data):
+        bid, index, slot = data
+        if slot is not None:
+            self.slots[(bid, index)] = slot
+        return bid, index
 
     def batch(self):
-        return self.workers.recv()
+        # the previous batch is released since the training step using it has finished
+        if self.in_use is not None:
+            self.slots[self.in_use].release()
+        self.depth_sum += self.workers.output_queue.qsize()
+        self.depth_cnt += 1
+        self.in_use = self.workers.recv()
+        if self.in_use is None:
+            return None  # shut down
+        return dict(self.slots[self.in_use].tensors)  # entries might be replaced in training
+
+    def adapt(self, wait_rate):
+        # change the number of active batchers and prefetch depth not to keep the trainer waiting
+        depth = self.depth_sum / max(1, self.depth_cnt)
+        self.depth_sum, self.depth_cnt = 0, 0
+        num_active, buffer_length = self.workers.num_active, self.workers.buffer_length
+        if wait_rate > 0.05:
+            if depth < 1 and num_active < self.args['maximum_batchers']:
+                num_active += 1  # batchers are too slow
+            elif buffer_length < self.workers.output_queue.maxsize:
+                buffer_length += 1  # batches arrive unevenly
+        elif wait_rate < 0.01 and depth > self.workers.output_queue.maxsize / 2:
+            if depth >= self.workers.output_queue.maxsize - 1 and buffer_length > 1:
+                buffer_length -= 1  # prefetched batches only wait in the full queue
+            elif num_active > self.args['minimum_batchers']:
+                num_active -= 1  # batches are more than needed
+        if (num_active, buffer_length) != (self.workers.num_active, self.workers.buffer_length):
+            print('batchers = %d, prefetch = %d' % (num_active, buffer_length))
+            self.workers.set_num_active(num_active)
+            self.workers.set_buffer_length(buffer_length)
+
+    def cache_hit_rate(self, reset=False):
+        hits, misses = self.cache_counts[0::2].sum(), self.cache_counts[1::2].sum()
+        if reset:
+            self.cache_counts[:] = 0
+        return hits / max(1, hits + misses)
 
     def shutdown(self):
         self.shutdown_flag = True
         self.workers.shutdown()
 
 
+class Prefetcher:
+    # keeps next batches staged in recycled buffers on the device
+    # batches are copied through pinned memory on another stream
+    # without GPU, batches are used in recycled slots of batchers since copying them only adds work
+    def __init__(self, batcher, num_batches, gpu):
+        self.batcher = batcher
+        self.gpu = gpu
+        self.ready_queue = queue.Queue(maxsize=num_batches)
+        self.free_buffers = queue.Queue()
+        self.host_buffers, self.host_shapes = None, None
+        self.in_use = None
+        self.stream = torch.cuda.Stream() if gpu else None
+        self.shutdown_flag = False
+
+    def _stage(self, batch):
+        shapes = map_r(batch, lambda t: t.shape)
+        if self.host_shapes != shapes:
+            self.host_buffers = map_r(batch, lambda t: torch.empty_like(t).pin_memory())
+            self.host_shapes = shapes
+        try:
+            buffers, event = self.free_buffers.get_nowait()
+        except queue.Empty:
+            buffers, event = None, None
+        if buffers is None or map_r(buffers, lambda t: t.shape) != shapes:
+            buffers, event = map_r(batch, lambda t: torch.empty_like(t, device='cuda')), None
+
+        bimap_r(self.host_buffers, batch, lambda h, t: h.copy_(t))
+        with torch.cuda.stream(self.stream):
+            if event is not None:
+                self.stream.wait_event(event)  # previous training step using the buffers
+            bimap_r(buffers, self.host_buffers, lambda d, h: d.copy_(h, non_blocking=True))
+        self.stream.synchronize()
+        return buffers
+
+    def run(self):
+        while not self.shutdown_flag:
+            batch = self.batcher.batch()
+            if batch is None:
+                break
+            batch = self._stage(batch)
+            while not self.shutdown_flag:
+                try:
+                    self.ready_queue.put(batch, timeout=0.3)
+                    break
+                except queue.Full:
+                    pass
+
+    def batch(self):
+        if not self.gpu:
+            return self.batcher.batch()
+        # buffers of the previous batch are recycled after the operations queued so far
+        if self.in_use is not None:
+            event = torch.cuda.Event()
+            event.record()
+            self.free_buffers.put((self.in_use, event))
+        self.in_use = None
+        while not self.shutdown_flag:
+            try:
+                self.in_use = self.ready_queue.get(timeout=0.3)
+                return dict(self.in_use)  # entries might be replaced in training
+            except queue.Empty:
+                pass
+        return None
+
+    def shutdown(self):
+        self.shutdown_flag = True
+
+
+def make_replay_buffer(args):
+    return ReplayBuffer(
+        args['maximum_episodes'], args['maximum_replay_mb'] << 20,
+        args['priority_exponent'] if args['prioritized_replay'] else None, args['priority_correction'],
+        args['replay_disk_path'], args['maximum_disk_replay_mb'] << 20, args['replay_segment_mb'] << 20
+    )
+
+
 class Trainer:
-    def __init__(self, args, model):
-        self.episodes = deque()
+    def __init__(self, args, model, update_callback, episodes=None):
         self.args = args
-        self.gpu = torch.cuda.device_count()
+        # episodes are written in another process in data parallel training
+        self.episodes = episodes if episodes is not None else make_replay_buffer(args)
+        self.rank, self.world_size = 0, 1
+        if distributed.is_available() and distributed.is_initialized():
+            self.rank, self.world_size = distributed.get_rank(), distributed.get_world_size()
+        self.gpu = torch.cuda.device_count() if self.world_size == 1 else 0  # gloo processes train on CPU
         self.model = model
         self.defalut_lr = 3e-8
         self.data_cnt_ema = self.args['batch_size'] * self.args['forward_steps']
@@ -409,37 +634,100 @@ class Trainer:
         self.steps = 0
         self.lock = threading.Lock()
         self.batcher = Batcher(self.args, self.episodes)
-        self.updated_model = None, 0
+        self.prefetcher = Prefetcher(self.batcher, self.args['prefetch_batches'], self.gpu)
+        self.hidden_buffers = {}  # initial hidden states are not modified in training
+        self.loss_function = CompiledLoss(vtrace) if self.args['compile_training'] else vtrace
+        self.update_callback = update_callback
         self.update_flag = False
+        self.snapshot = None
+        self.replay_warned = False
         self.shutdown_flag = False
 
-    def update(self):
-        if len(self.episodes) < self.args['minimum_episodes']:
-            return None, 0  # return None before training
-        self.update_flag = True
-        while True:
-            time.sleep(0.1)
-            model, steps = self.recheck_update()
-            if model is not None:
-                break
-        return model, steps
+    def feed(self, episodes):
+        # old episodes are evicted in the replay buffer
+        self.episodes.extend(episodes)
 
-    def report_update(self, model, steps):
+    def update(self, snapshot=None):
+        # request model trained so far, which is passed to update_callback after current step
+        # snapshot is a pair of path and learner state to be saved with trainer state
+        if len(self.episodes) < self.args['minimum_episodes']:
+            replay_stats = self.episodes.stats()
+            if replay_stats['evicted_episodes'] > 0 and not self.replay_warned:
+                # byte budget is exhausted before storing minimum episodes, so training never starts
+                print('warning: replay buffer holds only %d episodes in maximum_replay_mb, fewer than minimum_episodes %d'
+                      % (replay_stats['episodes'], self.args['minimum_episodes']))
+                self.replay_warned = True
+            return False  # no training before storing minimum episodes
         self.lock.acquire()
-        self.update_flag = False
-        self.updated_model = model, steps
+        self.update_flag = True
+        self.snapshot = snapshot
         self.lock.release()
+        return True
 
-    def recheck_update(self):
+    def report_update(self, model, steps):
         self.lock.acquire()
-        flag = self.update_flag
+        requested, snapshot = self.update_flag, self.snapshot
+        self.update_flag, self.snapshot = False, None
         self.lock.release()
-        return (None, -1) if flag else self.updated_model
+        if requested:
+            if snapshot is not None:
+                self.save_snapshot(*snapshot)
+            self.update_callback(model, steps)
+
+    def save_snapshot(self, path, learner_state):
+        # save everything needed to restart training without generating episodes again
+        start_time = time.time()
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        torch.save({
+            'optimizer': self.optimizer.state_dict() if self.optimizer is not None else None,
+            'steps': self.steps,
+            'data_cnt_ema': self.data_cnt_ema,
+        }, os.path.join(tmp_path, 'trainer.pth'))
+        self.episodes.save(os.path.join(tmp_path, 'replay'))
+        with open(os.path.join(tmp_path, 'learner.pkl'), 'wb') as f:
+            pickle.dump(learner_state, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        print('saved snapshot (%d episodes, %.3f sec)' % (len(self.episodes), time.time() - start_time))
+
+    def load_snapshot(self, path):
+        start_time = time.time()
+        state = torch.load(os.path.join(path, 'trainer.pth'))
+        if self.optimizer is not None and state['optimizer'] is not None:
+            self.optimizer.load_state_dict(state['optimizer'])
+        self.steps = state['steps']
+        self.data_cnt_ema = state['data_cnt_ema']
+        if self.world_size == 1:  # the replay buffer shared among ranks is loaded by DistributedTrainer
+            self.episodes.load(os.path.join(path, 'replay'))
+            print('loaded snapshot (%d episodes, %.3f sec)' % (len(self.episodes), time.time() - start_time))
 
     def shutdown(self):
         self.shutdown_flag = True
+        self.prefetcher.shutdown()
         self.batcher.shutdown()
 
+    def _follow_rank0(self, flag):
+        # every rank follows decisions of rank 0 not to leave others waiting in collective operations
+        if self.world_size == 1:
+            return flag
+        flags = torch.tensor([flag, self.shutdown_flag], dtype=torch.uint8)
+        distributed.broadcast(flags, 0)
+        self.shutdown_flag = bool(flags[1])
+        return bool(flags[0])
+
+    def _average_gradients(self):
+        # gradients of all parameters are averaged in one all-reduce
+        grads = [p.grad if p.grad is not None else torch.zeros_like(p) for p in self.params]
+        flat_grads = torch.cat([g.reshape(-1) for g in grads])
+        distributed.all_reduce(flat_grads)
+        flat_grads /= self.world_size
+        offset = 0
+        for p in self.params:
+            p.grad = flat_grads[offset:offset + p.numel()].view_as(p)
+            offset += p.numel()
+
     def train(self):
         if self.optimizer is None:  # non-parametric model
             print()
@@ -453,29 +741,60 @@ class Trainer:
             train_model.cuda()
         train_model.train()
 
-        while data_cnt == 0 or not (self.update_flag or self.shutdown_flag):
+        wait_time, start_time = 0, time.time()
+        while self._follow_rank0(data_cnt == 0 or not (self.update_flag and batch_cnt >= self.args['update_steps'] or self.shutdown_flag)):
             # episodes were only tuple of arrays
-            batch = to_gpu_or_not(self.batcher.batch(), self.gpu)
+            t = time.time()
+            batch = self.prefetcher.batch()
+            wait_time += time.time() - t
+            if batch is None:
+                break  # batchers are shut down
             batch_size = batch['value'].size(0)
             player_count = batch['value'].size(2)
-            hidden = to_gpu_or_not(self.model.init_hidden([batch_size, player_count]), self.gpu)
+            if (batch_size, player_count) not in self.hidden_buffers:
+                self.hidden_buffers[(batch_size, player_count)] = \
+                    to_gpu_or_not(self.model.init_hidden([batch_size, player_count]), self.gpu)
+            hidden = self.hidden_buffers[(batch_size, player_count)]
 
-            losses, dcnt = vtrace(batch, train_model, hidden, self.args)
+            losses, dcnt, errors = self.loss_function(batch, train_model, hidden, self.args)
 
             self.optimizer.zero_grad()
             losses['total'].backward()
+            if self.world_size > 1:
+                self._average_gradients()
             nn.utils.clip_grad_norm_(self.params, 4.0)
             self.optimizer.step()
+            if self.args['prioritized_replay']:
+                self.episodes.update_priorities(batch['id'].cpu().numpy(), errors.cpu().numpy())
 
             batch_cnt += 1
-            data_cnt += dcnt
+            data_cnt += dcnt.item()
             for k, l in losses.items():
                 loss_sum[k] = loss_sum.get(k, 0.0) + l.item()
 
             self.steps += 1
 
-        print('loss = %s' % ' '.join([k + ':' + '%.3f' % (l / data_cnt) for k, l in loss_sum.items()]))
-
+        wait_rate = wait_time / (time.time() - start_time)
+        if self.rank == 0:  # other ranks in data parallel training only train
+            print('loss = %s' % ' '.join([k + ':' + '%.3f' % (l / data_cnt) for k, l in loss_sum.items()]))
+            print('waiting batches = %.3f sec (%.1f%%)' % (wait_time, wait_rate * 100))
+        self.batcher.adapt(wait_rate)
+        if self.rank == 0:
+            print(format_stats('batchers', self.batcher.workers.stats(reset=True)))
+            if self.args['block_cache_mb'] > 0:
+                print('block cache hit rate = %.3f' % self.batcher.cache_hit_rate(reset=True))
+            replay_stats = self.episodes.stats()
+            replay_info = '%d episodes, %.1f MB used of %.1f MB' % (
+                replay_stats['episodes'], replay_stats['used_bytes'] / (1 << 20), replay_stats['allocated_bytes'] / (1 << 20))
+            if self.args['maximum_disk_replay_mb'] > 0:
+                replay_info += ', %d episodes in %.1f MB on disk' % (replay_stats['disk_episodes'], replay_stats['disk_bytes'] / (1 << 20))
+            print('replay buffer = ' + replay_info)
+
+        if self.world_size > 1:
+            # learning rate is decided from data of all ranks to keep parameters identical
+            counts = torch.tensor([data_cnt, batch_cnt], dtype=torch.float64)
+            distributed.all_reduce(counts)
+            data_cnt, batch_cnt = counts.tolist()
         self.data_cnt_ema = self.data_cnt_ema * 0.8 + data_cnt / (1e-2 + batch_cnt) * 0.2
         for param_group in self.optimizer.param_groups:
             param_group['lr'] = self.defalut_lr * self.data_cnt_ema / (1 + self.steps * 1e-5)
@@ -485,22 +804,276 @@ class Trainer:
 
     def run(self):
         print('waiting training')
+        started = False
         while not self.shutdown_flag:
-            if len(self.episodes) < self.args['minimum_episodes']:
+            if not started and not self._follow_rank0(len(self.episodes) >= self.args['minimum_episodes'] and not self.shutdown_flag):
                 time.sleep(1)
                 continue
-            if self.steps == 0:
+            if not started:
+                if self.world_size > 1:
+                    for tensor in self.model.state_dict().values():
+                        distributed.broadcast(tensor, 0)
                 self.batcher.run()
+                if self.gpu:
+                    threading.Thread(target=self.prefetcher.run, daemon=True).start()
                 print('started training')
+                started = True
             model = self.train()
             self.report_update(model, self.steps)
         print('finished training')
 
 
+class TrainerProcess:
+    # trainer in another process not to contend with request handling for GIL
+    # trained parameters are published through shared memory
+    def __init__(self, args, model, update_callback, num_processes=1):
+        self.args = args
+        self.update_callback = update_callback
+        self.shared_model = copy.deepcopy(model).share_memory()
+        self.steps = 0
+        self.lock = threading.Lock()
+        self.shutdown_flag = False
+
+        self.conns, self.processes = [], []
+        for rank in range(num_processes):
+            conn0, conn1 = mp.Pipe(duplex=True)
+            process = mp.Process(target=self._trainer_loop, args=(conn1, model, rank))
+            process.start()
+            conn1.close()
+            self.conns.append(conn0)
+            self.processes.append(process)
+        self.conn = self.conns[0]  # update is requested only to the first process and models come from it
+
+    def _make_trainer(self, model, publish, rank):
+        return Trainer(self.args, model, publish)
+
+    def _trainer_loop(self, conn, model, rank):
+        send_lock = threading.Lock()
+
+        def publish(model, steps):
+            # shared parameters are not written again until the learner copies them,
+            # since next update is requested after publishing this one
+            self.shared_model.load_state_dict(model.state_dict())
+            with send_lock:
+                conn.send(('updated', steps))
+
+        trainer = self._make_trainer(model, publish, rank)
+        thread = threading.Thread(target=trainer.run)
+        thread.start()
+        while True:
+            command, data = conn.recv()
+            if command == 'episodes':
+                trainer.feed(data)
+            elif command == 'update':
+                if not trainer.update(data):
+                    # every request is answered so that the learner never waits for rejected one
+                    with send_lock:
+                        conn.send(('rejected', None))
+            elif command == 'load':
+                trainer.load_snapshot(data)
+                with send_lock:
+                    conn.send(('loaded', None))
+            elif command == 'shutdown':
+                break
+        # training continues until the first process stops it, then batchers are shut down
+        trainer.shutdown_flag = True
+        thread.join()
+        trainer.shutdown()
+        if distributed.is_initialized():
+            distributed.destroy_process_group()
+
+    def feed(self, episodes):
+        self.lock.acquire()
+        self.conn.send(('episodes', episodes))
+        self.lock.release()
+
+    def update(self, snapshot=None):
+        # the trainer judges the number of episodes in its replay buffer,
+        # and current model is published again if it rejects the request
+        self.lock.acquire()
+        self.conn.send(('update', snapshot))
+        self.lock.release()
+        return True
+
+    def load_snapshot(self, path):
+        # called before run(), so that acknowledgements are received here
+        self.lock.acquire()
+        for conn in self.conns:
+            conn.send(('load', path))
+        for conn in self.conns:
+            command, _ = conn.recv()
+            assert command == 'loaded'
+        self.lock.release()
+
+    def shutdown(self):
+        self.shutdown_flag = True
+        self.lock.acquire()
+        for conn in self.conns:
+            try:
+                conn.send(('shutdown', None))
+            except BrokenPipeError:
+                pass
+        self.lock.release()
+        for process in self.processes:
+            process.join()
+
+    def run(self):
+        while not self.shutdown_flag:
+            if not self.conn.poll(0.3):
+                continue
+            command, steps = self.conn.recv()
+            if command == 'updated':
+                self.steps = steps
+                model = copy.deepcopy(self.shared_model)
+                self.update_callback(model, steps)
+            elif command == 'rejected':
+                model = copy.deepcopy(self.shared_model)
+                self.update_callback(model, self.steps)
+
+
+class DistributedTrainer(TrainerProcess):
+    # data parallel training in local processes with torch.distributed (gloo)
+    # episodes are written in this process to the replay buffer shared with trainer processes having own batchers
+    # gradients are averaged in every step, and rank 0 publishes trained models as TrainerProcess
+    def __init__(self, args, model, update_callback):
+        self.episodes = make_replay_buffer(args)
+        self.store_path = tempfile.mkdtemp()  # rendezvous of trainer processes
+        super().__init__(args, model, update_callback, args['num_trainers'])
+
+    def _make_trainer(self, model, publish, rank):
+        num_trainers = self.args['num_trainers']
+        distributed.init_process_group(
+            'gloo', init_method='file://' + os.path.join(self.store_path, 'store'),
+            rank=rank, world_size=num_trainers
+        )
+        # batchers are divided among ranks not to fork them (with their block caches) for each rank
+        args = dict(self.args)
+        for key in ['num_batchers', 'minimum_batchers', 'maximum_batchers']:
+            args[key] = max(1, args[key] // num_trainers)
+        return Trainer(args, model, publish, self.episodes)
+
+    def feed(self, episodes):
+        self.episodes.extend(episodes)
+
+    def load_snapshot(self, path):
+        # trainer states are loaded before episodes that let ranks start training
+        start_time = time.time()
+        super().load_snapshot(path)
+        self.episodes.load(os.path.join(path, 'replay'))
+        print('loaded snapshot (%d episodes, %.3f sec)' % (len(self.episodes), time.time() - start_time))
+
+    def shutdown(self):
+        super().shutdown()
+        shutil.rmtree(self.store_path, ignore_errors=True)
+
+
+class ModelCache:
+    # LRU cache of serialized historical models loaded in background
+    def __init__(self, load_func, size):
+        self.load_func = load_func
+        self.size = size
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+        self.load_queue = queue.Queue()
+        self.shutdown_flag = False
+
+    def get(self, model_id):
+        with self.lock:
+            model = self.models.get(model_id)
+            if model is not None:
+                self.models.move_to_end(model_id)
+            return model
+
+    def put(self, model_id, model):
+        with self.lock:
+            self.models[model_id] = model
+            self.models.move_to_end(model_id)
+            while len(self.models) > self.size:
+                self.models.popitem(last=False)
+
+    def request(self, model_ids, callback):
+        # callback is called with models (None if failed to load) in loader thread
+        self.load_queue.put((model_ids, callback))
+
+    def shutdown(self):
+        self.shutdown_flag = True
+
+    def run(self):
+        while not self.shutdown_flag:
+            try:
+                model_ids, callback = self.load_queue.get(timeout=0.3)
+            except queue.Empty:
+                continue
+            models = []
+            for model_id in model_ids:
+                model = self.get(model_id)
+                if model is None:
+                    model = self.load_func(model_id)
+                    if model is not None:
+                        self.put(model_id, model)
+                models.append(model)
+            callback(models)
+
+
+class CheckpointWriter:
+    # write checkpoints in background and publish latest one atomically
+    def __init__(self, path_func, latest_path, keep=0):
+        self.path_func = path_func
+        self.latest_path = latest_path
+        self.keep = keep  # number of numbered checkpoints to keep (0 keeps all)
+        self.saved_ids = deque()
+        self.write_queue = queue.Queue()
+        self.shutdown_flag = False
+
+    def save(self, model_id, model):
+        # model should not be modified after this call
+        self.write_queue.put((model_id, model))
+
+    def shutdown(self):
+        self.shutdown_flag = True
+
+    def _write(self, model_id, model):
+        path = self.path_func(model_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            torch.save(model.state_dict(), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+        # publish latest checkpoint by link without writing it again
+        latest_tmp_path = self.latest_path + '.tmp'
+        if os.path.exists(latest_tmp_path):
+            os.remove(latest_tmp_path)
+        try:
+            os.link(path, latest_tmp_path)
+        except OSError:
+            shutil.copyfile(path, latest_tmp_path)
+        os.replace(latest_tmp_path, self.latest_path)
+
+        self.saved_ids.append(model_id)
+        while self.keep > 0 and len(self.saved_ids) > self.keep:
+            old_path = self.path_func(self.saved_ids.popleft())
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+    def run(self):
+        # write all queued checkpoints before finishing
+        while not (self.shutdown_flag and self.write_queue.empty()):
+            try:
+                model_id, model = self.write_queue.get(timeout=0.3)
+            except queue.Empty:
+                continue
+            start_time = time.time()
+            self._write(model_id, model)
+            print('saved model %d (%.3f sec)' % (model_id, time.time() - start_time))
+
+
 class Learner:
     def __init__(self, args):
         self.args = args
         random.seed(args['seed'])
+        np.random.seed(args['seed'])
 
         self.env = make_env(args['env'])
         eval_modify_rate = (args['update_episodes'] ** 0.85) / args['update_episodes']
@@ -516,10 +1089,29 @@ class Learner:
         else:
             self.model = train_model
             self.model.load_state_dict(torch.load(self.model_path(self.model_era)), strict=False)
+        # read-only snapshot of the latest model for serving
+        self.model_snapshot = self.model_era, Serialized(self.model)
+
+        # checkpoints are saved in background
+        self.checkpoint_writer = CheckpointWriter(self.model_path, self.latest_model_path(), args['keep_checkpoints'])
+
+        # historical models requested by workers
+        self.model_cache = ModelCache(self.load_model, args['model_cache_size'])
+
+        # reported datum are stored by ingestion threads
+        self.ingest_queue = queue.Queue(maxsize=256)
+        self.lock = threading.Lock()
+
+        # generated episodes are also recorded in files if path is set
+        self.episode_writer = None
+        self.writer_lock = threading.Lock()
+        if args['record_path'] is not None:
+            self.episode_writer = EpisodeWriter(args['record_path'], args['record_shard_episodes'])
 
         # generated datum
         self.generation_results = {}
         self.num_episodes = 0
+        self.replay_episodes = 0  # episodes given to the replay buffer until the loaded snapshot
 
         # evaluated datum
         self.results = {}
@@ -528,15 +1120,28 @@ class Learner:
         # multiprocess or remote connection
         self.workers = Workers(args)
 
-        # thread connection
-        self.trainer = Trainer(args, train_model)
+        # thread (or process) connection
+        if args['num_trainers'] > 1:
+            trainer_class = DistributedTrainer
+        else:
+            trainer_class = TrainerProcess if args['trainer_process'] else Trainer
+        self.trainer = trainer_class(args, train_model, self.update_model)
+        self.update_event = threading.Event()
+        self.update_event.set()
+
+        if self.model_era > 0 and os.path.exists(self.snapshot_path()):
+            self.load_snapshot()
 
     def shutdown(self):
         self.shutdown_flag = True
+        self.model_cache.shutdown()
+        self.checkpoint_writer.shutdown()
         self.trainer.shutdown()
         self.workers.shutdown()
         for thread in self.threads:
             thread.join()
+        if self.episode_writer is not None:
+            self.episode_writer.close()
 
     def model_path(self, model_id):
         return os.path.join('models', str(model_id) + '.pth')
@@ -544,72 +1149,149 @@ class Learner:
     def latest_model_path(self):
         return os.path.join('models', 'latest.pth')
 
+    def snapshot_path(self):
+        return os.path.join('models', 'snapshot')
+
+    def load_snapshot(self):
+        path = self.snapshot_path()
+        with open(os.path.join(path, 'learner.pkl'), 'rb') as f:
+            state = pickle.load(f)
+        if state['model_era'] != self.model_era:
+            # snapshot is taken at another epoch, so it does not match the restarted model
+            print('warning: snapshot of epoch %d does not match restart epoch %d, start without it'
+                  % (state['model_era'], self.model_era))
+            return
+        print('loading snapshot of epoch %d' % state['model_era'])
+        self.generation_results, self.num_episodes = state['generation_results'], state['num_episodes']
+        self.results, self.num_results = state['results'], state['num_results']
+        # the replay buffer is saved after the learner state is taken, and might have more episodes
+        self.replay_episodes = int(np.load(os.path.join(path, 'replay.npz'))['num_appended'])
+        self.trainer.load_snapshot(path)
+
+    def load_model(self, model_id):
+        try:
+            model = self.model_class(self.env, self.args)
+            model.load_state_dict(torch.load(self.model_path(model_id)), strict=False)
+            return Serialized(model)
+        except:
+            return None
+
+    def reply_models(self, conn, multi_req, models):
+        # return latest model if failed to load specified model
+        send_data = [model if model is not None else self.model_snapshot[1] for model in models]
+        if not multi_req and len(send_data) == 1:
+            send_data = send_data[0]
+        self.workers.send(conn, send_data, 'model')
+
     def update_model(self, model, steps):
-        # get latest model and save it
+        # publish latest model and save it (called from trainer thread after training)
         print('updated model(%d)' % steps)
-        self.model_era += 1
+        self.model_cache.put(*self.model_snapshot)
+        model_era = self.model_era + 1
         self.model = model
-        os.makedirs('models', exist_ok=True)
-        torch.save(model.state_dict(), self.model_path(self.model_era))
-        torch.save(model.state_dict(), self.latest_model_path())
+        # serialize new model once for all requests
+        # (snapshot is replaced before era so that new era is always served)
+        self.model_snapshot = model_era, Serialized(model)
+        self.model_era = model_era
+        self.checkpoint_writer.save(model_era, model)
+        self.update_event.set()
 
     def feed_episodes(self, episodes):
-        # analyze generated episodes
-        for episode in episodes:
-            if episode is None:
-                continue
-            for p in episode['args']['player']:
-                model_id = episode['args']['model_id'][p]
-                outcome = episode['outcome'][p]
-                n, r, r2 = self.generation_results.get(model_id, (0, 0, 0))
-                self.generation_results[model_id] = n + 1, r + outcome, r2 + outcome ** 2
-
-        # store generated episodes
-        self.trainer.episodes.extend([e for e in episodes if e is not None])
-        while len(self.trainer.episodes) > self.args['maximum_episodes']:
-            self.trainer.episodes.popleft()
+        with self.lock:
+            # analyze generated episodes
+            for episode in episodes:
+                if episode is None:
+                    continue
+                for p in episode['args']['player']:
+                    model_id = episode['args']['model_id'][p]
+                    outcome = episode['outcome'][p]
+                    n, r, r2 = self.generation_results.get(model_id, (0, 0, 0))
+                    self.generation_results[model_id] = n + 1, r + outcome, r2 + outcome ** 2
+
+        # store generated episodes out of the stats lock
+        # so that ingestion threads encode and write them in parallel
+        episodes = [e for e in episodes if e is not None]
+        self.trainer.feed(episodes)
+        if self.episode_writer is not None:
+            with self.writer_lock:
+                self.episode_writer.write(episodes)
 
     def feed_results(self, results):
-        # store evaluation results
-        for result in results:
-            if result is None:
+        with self.lock:
+            # store evaluation results
+            for result in results:
+                if result is None:
+                    continue
+                for p in result['args']['player']:
+                    model_id = result['args']['model_id'][p]
+                    res = result['result'][p]
+                    n, r, r2 = self.results.get(model_id, (0, 0, 0))
+                    self.results[model_id] = n + 1, r + res, r2 + res ** 2
+
+    def ingest(self):
+        # store reported datum apart from the server thread
+        while not self.shutdown_flag:
+            try:
+                req, data = self.ingest_queue.get(timeout=0.3)
+            except queue.Empty:
                 continue
-            for p in result['args']['player']:
-                model_id = result['args']['model_id'][p]
-                res = result['result'][p]
-                n, r, r2 = self.results.get(model_id, (0, 0, 0))
-                self.results[model_id] = n + 1, r + res, r2 + res ** 2
+            if req == 'episode':
+                self.feed_episodes(data)
+            elif req == 'result':
+                self.feed_results(data)
 
     def update(self):
+        # wait for previous update only if trainer has not finished it within an epoch
+        self.update_event.wait()
+        self.update_event.clear()
+
         # call update to every component
         print()
         print('epoch %d' % self.model_era)
 
-        if self.model_era not in self.results:
+        with self.lock:
+            results = self.results.get(self.model_era)
+            generation_results = self.generation_results.get(self.model_era)
+
+        if results is None:
             print('win rate = Nan (0)')
         else:
-            n, r, r2 = self.results[self.model_era]
+            n, r, r2 = results
             mean = r / (n + 1e-6)
             print('win rate = %.3f (%.1f / %d)' % ((mean + 1) / 2, (r + n) / 2, n))
 
-        if self.model_era not in self.generation_results:
+        if generation_results is None:
             print('generation stats = Nan (0)')
         else:
-            n, r, r2 = self.generation_results[self.model_era]
+            n, r, r2 = generation_results
             mean = r / (n + 1e-6)
             std = (r2 / (n + 1e-6) - mean ** 2) ** 0.5
             print('generation stats = %.3f +- %.3f' % (mean, std))
 
-        model, steps = self.trainer.update()
-        if model is None:
-            model = self.model
-        self.update_model(model, steps)
+        print(format_stats('workers', self.workers.stats(reset=True)))
+        if self.args['remote']:
+            print('compression saved %d bytes' % self.workers.saved_bytes())
+
+        snapshot = None
+        interval = self.args['snapshot_interval']
+        if interval > 0 and (self.model_era + 1) % interval == 0:
+            with self.lock:
+                learner_state = {
+                    'model_era': self.model_era + 1,
+                    'generation_results': dict(self.generation_results), 'num_episodes': self.num_episodes,
+                    'results': dict(self.results), 'num_results': self.num_results,
+                }
+            snapshot = self.snapshot_path(), learner_state
+
+        # keep serving with current model while trainer finishes training
+        if not self.trainer.update(snapshot):
+            self.update_model(self.model, 0)
 
     def server(self):
         # central conductor server
         # returns as list if getting multiple requests as list
         print('started server')
-        prev_update_episodes = self.args['minimum_episodes']
+        prev_update_episodes = max(self.args['minimum_episodes'], self.num_episodes)
         while True:
             # no update call before storings minimum number of episodes + 1 age
             next_update_episodes = prev_update_episodes + self.args['update_episodes']
@@ -654,35 +1336,53 @@ class Learner:
 
                         send_data.append(args)
 
-                elif req == 'episode':
-                    # report generated episodes
-                    self.feed_episodes(data)
-                    send_data = [None] * len(data)
-
-                elif req == 'result':
-                    # report evaluation results
-                    self.feed_results(data)
+                elif req == 'episode' or req == 'result':
+                    # report generated episodes or evaluation results to ingestion threads
+                    self.ingest_queue.put((req, data))
                     send_data = [None] * len(data)
 
                 elif req == 'model':
+                    model_era, model_blob = self.model_snapshot
                     for model_id in data:
-                        model = self.model
-                        if model_id != self.model_era:
-                            try:
-                                model = self.model_class(self.env, self.args)
-                                model.load_state_dict(torch.load(self.model_path(model_id)), strict=False)
-                            except:
-                                # return latest model if failed to load specified model
-                                pass
-                        send_data.append(model)
+                        if model_id == model_era:
+                            send_data.append(model_blob)
+                        else:
+                            send_data.append(self.model_cache.get(model_id))
+                    if any(model is None for model in send_data):
+                        # reply after loading models without blocking other requests
+                        self.model_cache.request(data, functools.partial(self.reply_models, conn, multi_req))
+                        continue
 
                 if not multi_req and len(send_data) == 1:
                     send_data = send_data[0]
-                self.workers.send(conn, send_data)
+                self.workers.send(conn, send_data, req)
             prev_update_episodes = next_update_episodes
             self.update()
         print('finished server')
 
+    def offline_server(self, path):
+        # conductor feeding recorded episodes instead of generating them
+        # episodes already given to the replay buffer before restart are skipped
+        print('started offline server')
+        self.num_episodes = self.replay_episodes
+        episodes = itertools.islice(read_episodes(path), self.num_episodes, None)
+        prev_update_episodes = max(self.args['minimum_episodes'], self.num_episodes)
+        while not self.shutdown_flag:
+            next_update_episodes = prev_update_episodes + self.args['update_episodes']
+            chunk = list(itertools.islice(episodes, next_update_episodes - self.num_episodes))
+            if len(chunk) == 0:
+                # no update without new episodes
+                print('used all recorded episodes (%d)' % self.num_episodes)
+                break
+            self.feed_episodes(chunk)
+            self.num_episodes += len(chunk)
+            print(self.num_episodes, end=' ', flush=True)
+            prev_update_episodes = next_update_episodes
+            self.update()
+        # wait for the last model
+        self.update_event.wait()
+        print('finished offline server')
+
     def entry_server(self):
         port = 9999
         print('started entry server %d' % port)
@@ -692,23 +1392,33 @@ class Learner:
             if conn is not None:
                 entry_args = conn.recv()
                 print('accepted entry from %s!' % entry_args['host'])
+                entry_args['compression'] = select_compression(entry_args.get('compression'))
                 args = copy.deepcopy(self.args)
                 args['worker'] = entry_args
                 conn.send(args)
                 conn.close()
         print('finished entry server')
 
-    def run(self):
+    def run(self, offline_path=None):
         try:
             # open threads
-            self.threads = [threading.Thread(target=self.trainer.run)]
+            self.threads = [
+                threading.Thread(target=self.trainer.run),
+                threading.Thread(target=self.model_cache.run),
+                threading.Thread(target=self.checkpoint_writer.run),
+            ]
+            for _ in range(self.args['num_ingesters']):
+                self.threads.append(threading.Thread(target=self.ingest))
             if self.args['remote']:
                 self.threads.append(threading.Thread(target=self.entry_server))
             for thread in self.threads:
                 thread.start()
-            # open generator, evaluator
-            self.workers.run()
-            self.server()
+            if offline_path is not None:
+                self.offline_server(offline_path)
+            else:
+                # open generator, evaluator
+                self.workers.run()
+                self.server()
 
         finally:
             self.shutdown()
@@ -735,3 +1445,25 @@ def train_server_main(args):
 
     learner = Learner(train_args)
     learner.run()
+
+
+def train_offline_main(args, argv):
+    # training with recorded episodes without workers
+    train_args = args['train_args']
+    train_args['remote'] = False
+
+    env_args = args['env_args']
+    train_args['env'] = env_args
+
+    path = argv[0] if len(argv) > 0 else train_args['record_path']
+    if path is None:
+        print('Please set path of recorded episodes.')
+        return
+    if train_args['update_steps'] <= 0:
+        print('Please set update_steps for offline training.')
+        return
+    train_args['record_path'] = None  # not to record episodes again
+
+    prepare_env(env_args)
+    learner = Learner(train_args)
+    learner.run(offline_path=path)
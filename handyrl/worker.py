@@ -3,6 +3,7 @@
 
 # worker and gather
 
+import os
 import random
 import threading
 import time
@@ -13,8 +14,9 @@ import multiprocessing as mp
 
 from .environment import prepare_env, make_env
 from .connection import QueueCommunicator
-from .connection import send_recv, open_multiprocessing_connections
+from .connection import send_recv, send_recv_many, open_multiprocessing_connections
 from .connection import connect_socket_connection, accept_socket_connections
+from .connection import select_compression, Serialized
 from .evaluation import Evaluator
 from .generation import Generator
 
@@ -85,11 +87,12 @@ def open_worker(args, conn, wid):
 
 
 class Gather(QueueCommunicator):
-    def __init__(self, args, conn, gaid):
+    def __init__(self, args, conn, gaid, reconnect=None):
         print('started gather %d' % gaid)
         super().__init__()
         self.gather_id = gaid
         self.server_conn = conn
+        self.reconnect = reconnect
         self.args_queue = deque([])
         self.data_map = {'model': {}}
         self.result_send_map = {}
@@ -113,6 +116,24 @@ class Gather(QueueCommunicator):
     def __del__(self):
         print('finished gather %d' % self.gather_id)
 
+    def server_send_recv(self, send_data):
+        return self.server_send_recv_many([send_data])[0]
+
+    def server_send_recv_many(self, send_data_list):
+        # retry until acknowledged since remote gather reconnects when the link drops
+        # only requests answered in order by the server (not models) are sent together
+        while True:
+            try:
+                if self.server_conn is None:
+                    self.server_conn = self.reconnect()
+                return send_recv_many(self.server_conn, send_data_list)
+            except (OSError, EOFError):
+                if self.reconnect is None:
+                    raise
+                print('lost connection to server in gather %d' % self.gather_id)
+                self.server_conn = None
+                time.sleep(1)
+
     def run(self):
         while True:
             conn, (command, args) = self.recv()
@@ -120,23 +141,24 @@ class Gather(QueueCommunicator):
                 # When requested argsments, return buffered outputs
                 if len(self.args_queue) == 0:
                     # get muptilple arguments from server and store them
-                    self.server_conn.send((command, [None] * self.args_buf_len))
-                    self.args_queue += self.server_conn.recv()
+                    # buffered datum are sent together not to wait for the server twice
+                    requests = self.result_requests() + [(command, [None] * self.args_buf_len)]
+                    self.args_queue += self.server_send_recv_many(requests)[-1]
 
                 next_args = self.args_queue.popleft()
-                self.send(conn, next_args)
+                self.send(conn, next_args, command)
 
             elif command in self.data_map:
                 # answer data request as soon as possible
                 data_id = args
                 if data_id not in self.data_map[command]:
-                    self.server_conn.send((command, args))
-                    self.data_map[command][data_id] = self.server_conn.recv()
-                self.send(conn, self.data_map[command][data_id])
+                    # keep serialized data to answer every worker without pickling again
+                    self.data_map[command][data_id] = Serialized(self.server_send_recv((command, args)))
+                self.send(conn, self.data_map[command][data_id], command)
 
             else:
                 # return flag first and store data
-                self.send(conn, None)
+                self.send(conn, None, command)
                 if command not in self.result_send_map:
                     self.result_send_map[command] = []
                 self.result_send_map[command].append(args)
@@ -144,16 +166,26 @@ class Gather(QueueCommunicator):
 
                 if self.result_send_cnt >= self.result_buf_len:
                     # send datum to server after buffering certain number of datum
-                    for command, args_list in self.result_send_map.items():
-                        self.server_conn.send((command, args_list))
-                        self.server_conn.recv()
-                    self.result_send_map = {}
-                    self.result_send_cnt = 0
+                    # (datum are kept until acknowledged to be sent again after reconnection)
+                    # arguments are also requested ahead if running short
+                    requests = self.result_requests()
+                    prefetch = len(self.args_queue) < self.args_buf_len
+                    if prefetch:
+                        requests.append(('args', [None] * self.args_buf_len))
+                    replies = self.server_send_recv_many(requests)
+                    if prefetch:
+                        self.args_queue += replies[-1]
+
+    def result_requests(self):
+        requests = list(self.result_send_map.items())
+        self.result_send_map = {}
+        self.result_send_cnt = 0
+        return requests
 
 
-def gather_loop(args, conn, gaid):
+def gather_loop(args, conn, gaid, reconnect=None):
     try:
-        gather = Gather(args, conn, gaid)
+        gather = Gather(args, conn, gaid, reconnect)
         gather.run()
     finally:
         gather.shutdown()
@@ -163,6 +195,7 @@ class Workers(QueueCommunicator):
     def __init__(self, args):
         super().__init__()
         self.args = args
+        self.sessions = {}
 
     def run(self):
         if self.args['remote']:
@@ -173,6 +206,18 @@ class Workers(QueueCommunicator):
                 while not self.shutdown_flag:  # use super class's flag
                     conn = next(conn_acceptor)
                     if conn is not None:
+                        # remote gather sends link options negotiated at entry
+                        try:
+                            options = conn.recv()
+                        except (ConnectionResetError, EOFError):
+                            continue
+                        conn.set_compression(options['compression'], options['compress_threshold'])
+                        session = options['session']
+                        if session in self.sessions:
+                            # drop half-open connection of reconnected gather
+                            print('resumed session %s' % session)
+                            self.disconnect(self.sessions[session])
+                        self.sessions[session] = conn
                         self.add(conn)
                 print('finished worker server')
             # use super class's thread list
@@ -188,17 +233,33 @@ class Workers(QueueCommunicator):
 
 
 def entry(entry_args):
-    conn = connect_socket_connection(entry_args['remote_host'], 9999)
+    conn = connect_socket_connection(entry_args['remote_host'], 9999, retry=True)
     conn.send(entry_args)
     args = conn.recv()
     conn.close()
     return args
 
 
+def connect_server(worker_args, session):
+    conn = connect_socket_connection(worker_args['remote_host'], 9998, retry=True)
+    options = {k: worker_args[k] for k in ['compression', 'compress_threshold']}
+    options['session'] = session
+    conn.send(options)
+    conn.set_compression(options['compression'], options['compress_threshold'])
+    return conn
+
+
+def reconnect_server(entry_args, session):
+    # entry again since the learner might have been restarted
+    args = entry(entry_args)
+    return connect_server(args['worker'], session)
+
+
 def worker_main(args):
     # offline generation worker
     entry_args = args['entry_args']
     entry_args['host'] = gethostname()
+    entry_args['compression'] = select_compression(entry_args['compression'])
 
     args = entry(entry_args)
     print(args)
@@ -208,8 +269,10 @@ def worker_main(args):
     process = []
     try:
         for i in range(args['worker']['num_gather']):
-            conn = connect_socket_connection(args['worker']['remote_host'], 9998)
-            p = mp.Process(target=gather_loop, args=(args, conn, i))
+            session = '%s-%d-%d' % (entry_args['host'], os.getpid(), i)
+            conn = connect_server(args['worker'], session)
+            reconnect = functools.partial(reconnect_server, entry_args, session)
+            p = mp.Process(target=gather_loop, args=(args, conn, i, reconnect))
             p.start()
             conn.close()
             process.append(p)
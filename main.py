@@ -22,6 +22,9 @@ if __name__ == '__main__':
     if mode == '--train-server' or mode == '-ts':
         from handyrl.train import train_server_main as main
         main(args)
+    elif mode == '--train-offline' or mode == '-to':
+        from handyrl.train import train_offline_main as main
+        main(args, sys.argv[2:])
     elif mode == '--worker' or mode == '-w':
         from handyrl.worker import worker_main as main
         main(args)
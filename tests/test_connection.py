@@ -0,0 +1,103 @@
+import os
+import pickle
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+from handyrl.connection import PickledConnection, QueueCommunicator, send_recv_many
+
+
+@pytest.fixture
+def conn_pair():
+    s0, s1 = socket.socketpair()
+    conn0, conn1 = PickledConnection(s0), PickledConnection(s1)
+    yield conn0, conn1
+    conn0.close()
+    conn1.close()
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'lz4'])  # lz4 falls back to zlib if not installed
+def test_compression(conn_pair, codec):
+    """Test compressed frames are restored and only compressible large data is compressed"""
+    conn0, conn1 = conn_pair
+    conn0.set_compression(codec, threshold=1024)
+
+    data = {'board': [0] * 10000, 'name': 'x' * 5000}
+    conn0.send(data)
+    assert conn1.recv() == data
+    saved = conn0.saved_bytes['send']
+    assert saved > 0 and conn1.saved_bytes['recv'] == saved
+
+    # small or incompressible data is sent as it is
+    small, noise = b'a' * 100, os.urandom(100000)
+    conn0.send_bytes(small)
+    conn0.send_bytes(noise)
+    assert conn1.recv_bytes() == small
+    assert conn1.recv_bytes() == noise
+    assert conn0.saved_bytes['send'] == saved and conn1.saved_bytes['recv'] == saved
+
+
+def test_coalesced_frames(conn_pair):
+    """Test frames written at once are split by read ahead"""
+    conn0, conn1 = conn_pair
+    messages = [b'', b'x', os.urandom(1000), b'y' * 10]
+    conn0.send_bytes_many(messages)
+
+    received = [conn1.recv_bytes()]
+    while conn1.buffered():
+        received.append(conn1.recv_bytes())
+    assert received == messages
+
+    # frames larger than read ahead size are received in pieces
+    messages = [os.urandom(200000), b'z']
+    conn0.send_bytes_many(messages)
+    assert [conn1.recv_bytes() for _ in messages] == messages
+
+    # frame is not buffered until its whole payload arrives
+    conn0.conn.sendall(struct.pack('!iB', 1, 0) + b'a' + struct.pack('!iB', 4, 0) + b'bc')
+    assert conn1.recv_bytes() == b'a'
+    assert not conn1.buffered()
+    conn0.conn.sendall(b'de')
+    assert conn1.recv_bytes() == b'bcde'
+
+
+def test_send_recv_many(conn_pair):
+    """Test pipelined requests get replies in order"""
+    conn0, conn1 = conn_pair
+
+    def server():
+        for _ in range(3):
+            command, data = conn1.recv()
+            conn1.send((command, data * 2))
+
+    thread = threading.Thread(target=server)
+    thread.start()
+    requests = [('episode', [1, 2]), ('result', [3]), ('args', [None])]
+    assert send_recv_many(conn0, requests) == [(c, d * 2) for c, d in requests]
+    thread.join()
+
+
+def test_reply_labels(conn_pair):
+    """Test coalesced replies are counted for commands of their requests"""
+    conn0, conn1 = conn_pair
+    communicator = QueueCommunicator([conn1])
+    try:
+        conn0.send_bytes_many([pickle.dumps(('episode', [1, 2])), pickle.dumps(('args', [None] * 3))])
+        for _ in range(2):
+            conn, (command, data) = communicator.recv()
+            communicator.send(conn, [command] * len(data), command)
+        assert conn0.recv() == ['episode'] * 2
+        assert conn0.recv() == ['args'] * 3
+        for _ in range(100):  # sent messages are recorded after written
+            counters = communicator.stats()['counters']
+            if ('send', 'all', 'msgs') in counters and counters[('send', 'all', 'msgs')] == 2:
+                break
+            time.sleep(0.01)
+        for command in ['episode', 'args']:
+            assert counters[('recv', 'command ' + command, 'msgs')] == 1
+            assert counters[('send', 'command ' + command, 'msgs')] == 1
+    finally:
+        communicator.shutdown()
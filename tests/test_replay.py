@@ -0,0 +1,218 @@
+import threading
+import multiprocessing as mp
+
+import numpy as np
+import pytest
+
+from handyrl.replay import ReplayBuffer, SumTree
+
+
+def make_episode(index, num_blocks=3, block_size=100):
+    # blocks are distinguishable by the episode index and the block index
+    moment = [('%d-%d' % (index, i)).encode().ljust(block_size, b'.') for i in range(num_blocks)]
+    return {'args': {'index': index}, 'outcome': {0: 1, 1: -1}, 'steps': num_blocks * 4, 'moment': moment}
+
+
+def check_samples(buffer, num_samples=256, forward_steps=5, compress_steps=4):
+    # sampled blocks are the same as written ones, and no evicted episode is sampled
+    episodes = buffer.sample(num_samples, forward_steps, compress_steps)
+    assert len(episodes) == num_samples
+    for ep in episodes:
+        assert buffer.state[0] <= ep['id'] < buffer.state[1]
+        expected = make_episode(ep['args']['index'])
+        st_block = ep['base'] // compress_steps
+        assert ep['start'] - ep['base'] < compress_steps
+        assert ep['end'] <= ep['total'] == expected['steps']
+        assert [bytes(ms) for ms in ep['moment']] == expected['moment'][st_block:st_block + len(ep['moment'])]
+        assert ep['base'] + len(ep['moment']) * compress_steps >= ep['end']
+    return episodes
+
+
+def test_episode_limit():
+    """Test the oldest episodes are evicted over maximum episodes"""
+    np.random.seed(0)
+    buffer = ReplayBuffer(10, 1 << 20)
+    buffer.extend([make_episode(i) for i in range(25)])
+    assert len(buffer) == 10
+    assert buffer.stats()['evicted_episodes'] == 15
+    # the oldest episode is rarely accepted in sampling giving priority to recent ones
+    episodes = check_samples(buffer, num_samples=1000)
+    assert set(ep['args']['index'] for ep in episodes) == set(range(15, 25))
+
+
+def test_byte_budget():
+    """Test records wrap around in the byte budget evicting the oldest ones"""
+    np.random.seed(0)
+    buffer = ReplayBuffer(1000, 4000)
+    for i in range(0, 60, 7):
+        buffer.extend([make_episode(j) for j in range(i, min(i + 7, 60))])
+        stats = buffer.stats()
+        assert 0 < stats['used_bytes'] <= stats['allocated_bytes']
+        assert stats['episodes'] + stats['evicted_episodes'] == min(i + 7, 60)
+        episodes = check_samples(buffer)
+    assert 5 < len(buffer) < 12
+    assert set(ep['args']['index'] for ep in episodes) == set(range(60 - len(buffer), 60))
+
+    # too large episode is not stored
+    buffer.extend([make_episode(60, block_size=5000)])
+    assert buffer.state[1] == 60
+
+
+def test_save_load(tmp_path):
+    """Test saved episodes are loaded in the same order"""
+    buffer = ReplayBuffer(1000, 4000)
+    buffer.extend([make_episode(i) for i in range(30)])
+    path = str(tmp_path / 'replay')
+    buffer.save(path)
+
+    loaded = ReplayBuffer(100, 1 << 20)
+    loaded.extend([make_episode(i) for i in range(100, 103)])
+    loaded.load(path)
+    assert len(loaded) == len(buffer) + 3
+    assert loaded.num_appended[0] == 3 + 30  # including evicted ones
+    head = 30 - len(buffer)
+    indices = [loaded._read(serial, serial)['args']['index'] for serial in range(loaded.state[0], loaded.state[1])]
+    assert indices == [100, 101, 102] + list(range(head, 30))
+    assert np.array_equal(loaded.steps[3:len(loaded)], buffer.steps[np.arange(head, 30) % 1000])
+    check_samples(loaded)
+
+    # empty buffer is saved as well
+    ReplayBuffer(10, 1000).save(path)
+    loaded.load(path)
+    assert len(loaded) == len(buffer) + 3
+
+
+@pytest.mark.parametrize('disk', [False, True])
+def test_save_while_writing(tmp_path, disk):
+    """Test saving does not block writing, and saved episodes are consistent"""
+    disk_args = {'disk_path': str(tmp_path / 'disk'), 'maximum_disk_bytes': 3000, 'segment_bytes': 1000} if disk else {}
+    buffer = ReplayBuffer(1000, 2000, **disk_args)
+    buffer.extend([make_episode(i) for i in range(10)])
+
+    def writer():
+        for i in range(10, 2000):
+            buffer.extend([make_episode(i)])
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    path = str(tmp_path / 'replay')
+    while thread.is_alive():
+        buffer.save(path)
+        loaded = ReplayBuffer(1000, 1 << 20)
+        loaded.load(path)
+        indices = [loaded._read(serial, serial)['args']['index'] for serial in range(len(loaded))]
+        assert indices == sorted(indices) and (len(indices) == 0 or indices[-1] < loaded.num_appended[0])
+        for serial, index in enumerate(indices):
+            assert [bytes(ms) for ms in loaded._read(serial, serial)['moment']] == make_episode(index)['moment']
+    thread.join()
+
+
+@pytest.mark.parametrize('forward_steps', [1, 5, 12, 16])
+def test_sample_turns(forward_steps):
+    """Test sampled blocks cover the sampled turns"""
+    buffer = ReplayBuffer(100, 1 << 20)
+    buffer.extend([make_episode(i) for i in range(20)])
+    episodes = check_samples(buffer, forward_steps=forward_steps)
+    for ep in episodes:
+        assert ep['end'] - ep['start'] == min(forward_steps, ep['total'])
+
+
+def test_forked_reader():
+    """Test a forked process samples episodes written after the fork"""
+    buffer = ReplayBuffer(10, 4000)
+
+    def reader(conn):
+        # episodes might be evicted after sampled while written in parallel
+        indices = set()
+        while len(indices) < 5:
+            for ep in buffer.sample(16, 5, 4):
+                expected = make_episode(ep['args']['index'])['moment'][ep['base'] // 4:]
+                assert [bytes(ms) for ms in ep['moment']] == expected[:len(ep['moment'])]
+                indices.add(ep['args']['index'])
+        conn.send(indices)
+
+    conn0, conn1 = mp.get_context('fork').Pipe()
+    process = mp.get_context('fork').Process(target=reader, args=(conn1,))
+    process.start()
+    for i in range(20):
+        buffer.extend([make_episode(i)])
+    assert conn0.poll(10)
+    indices = conn0.recv()
+    process.join()
+    assert process.exitcode == 0
+    assert indices <= set(range(20))
+
+
+@pytest.mark.parametrize('capacity', [2, 5, 8, 13])
+def test_sum_tree(capacity):
+    """Test leaves are found in proportion to priorities"""
+    np.random.seed(capacity)
+    tree = SumTree(capacity)
+    priorities = np.arange(capacity, dtype=np.float64) + 1
+    priorities[capacity // 2] = 0
+    tree.update(np.arange(capacity), priorities)
+    assert tree.total() == pytest.approx(priorities.sum())
+    assert np.array_equal(tree.get(np.arange(capacity)), priorities)
+
+    leaves = tree.find(np.random.random(100000) * tree.total())
+    assert leaves.max() < capacity
+    frequency = np.bincount(leaves, minlength=capacity) / len(leaves)
+    assert np.allclose(frequency, priorities / priorities.sum(), atol=0.01)
+
+    # a value on the boundary of cumulative sums belongs to the next leaf with positive priority
+    bounds = np.cumsum(priorities)[:-1]
+    bounds = bounds[bounds < tree.total()]
+    assert np.array_equal(tree.find(bounds), np.searchsorted(np.cumsum(priorities), bounds, side='right'))
+
+
+def test_prioritized_sample():
+    """Test evicted episodes are never sampled and errors change priorities"""
+    np.random.seed(0)
+    buffer = ReplayBuffer(8, 4000, priority_exponent=1.0, priority_correction=0.5)
+    buffer.extend([make_episode(i) for i in range(30)])
+    assert buffer.priorities.total() == pytest.approx(len(buffer))
+    check_samples(buffer, num_samples=1000)
+
+    # priorities of evicted episodes are not updated
+    head, tail = int(buffer.state[0]), int(buffer.state[1])
+    serials = np.arange(head - 4, tail)
+    errors = np.where(serials == tail - 1, 100.0, 1.0)
+    buffer.update_priorities(serials, errors)
+    assert buffer.priorities.total() == pytest.approx(100.001 + (tail - head - 1) * 1.001)
+    episodes = check_samples(buffer, num_samples=1000)
+    ratio = np.mean([ep['id'] == tail - 1 for ep in episodes])
+    assert ratio > 0.5
+
+    # rarely sampled episodes have large weights
+    weights = {ep['id']: ep['weight'] for ep in episodes}
+    assert weights[tail - 1] < min(w for serial, w in weights.items() if serial != tail - 1)
+
+
+def test_disk_tier(tmp_path):
+    """Test old records are moved to segment files and removed with their episodes"""
+    np.random.seed(0)
+    buffer = ReplayBuffer(1000, 2000, disk_path=str(tmp_path), maximum_disk_bytes=3000, segment_bytes=1000)
+    for i in range(0, 60, 3):
+        buffer.extend([make_episode(j) for j in range(i, i + 3)])
+        stats = buffer.stats()
+        assert stats['used_bytes'] <= 2000 and stats['disk_bytes'] <= 3000
+        # episodes in removed segments are evicted, and the others are kept in memory or on disk
+        first_segment_id, _, first_serial = buffer.disk_segments[0] if len(buffer.disk_segments) > 0 else (0, 0, 0)
+        assert buffer.state[0] == first_serial and buffer.state[2] == first_segment_id
+        assert len(list(tmp_path.glob('*.seg'))) == len(buffer.disk_segments)
+        for serial in range(buffer.state[0], buffer.state[1]):
+            ep = buffer._read(serial, serial % 1000)
+            assert ep['args']['index'] == serial
+            assert [bytes(ms) for ms in ep['moment']] == make_episode(serial)['moment']
+        episodes = check_samples(buffer)
+    assert buffer.state[2] > 0 and 0 < stats['disk_episodes'] < len(buffer)
+    assert any(ep['id'] < buffer.usage[1] for ep in episodes)
+    assert set(ep['args']['index'] for ep in episodes) == set(range(int(buffer.state[0]), 60))
+
+    # episodes on disk are saved as well
+    path = str(tmp_path / 'replay')
+    buffer.save(path)
+    loaded = ReplayBuffer(1000, 1 << 20)
+    loaded.load(path)
+    assert len(loaded) == len(buffer)
+    check_samples(loaded)
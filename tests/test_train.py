@@ -0,0 +1,170 @@
+import random
+import multiprocessing as mp
+from collections import deque
+
+import numpy as np
+import pytest
+import torch
+
+from handyrl.environment import make_env
+from handyrl.generation import Generator
+from handyrl.model import SimpleConv2DModel, to_torch
+from handyrl.train import backward_scan, make_batch, decode_block, BlockCache, BatchSlot
+from handyrl.util import map_r, bimap_r, rotate
+
+
+def loop_scan(deltas, decays):
+    # recursion as previously written in vtrace
+    xs = deque([deltas[:, -1]])
+    for i in range(deltas.size(1) - 2, -1, -1):
+        xs.appendleft(deltas[:, i] + decays[:, i] * xs[0])
+    return torch.stack(tuple(xs), dim=1)
+
+
+@pytest.mark.parametrize('time_length', [1, 2, 3, 8, 16, 33, 64])
+def test_backward_scan(time_length):
+    """Test backward scan matches the step by step recursion"""
+    torch.manual_seed(time_length)
+    deltas = torch.randn(8, time_length, 2, 1)
+    for decays in [torch.rand(8, time_length, 1, 1), torch.full_like(deltas, 0.7), torch.zeros_like(deltas)]:
+        assert torch.allclose(backward_scan(deltas, decays), loop_scan(deltas, decays.expand_as(deltas)), atol=1e-5)
+
+
+def test_td_lambda_targets():
+    """Test lambda values and returns computed with backward scan as in vtrace"""
+    torch.manual_seed(0)
+    values, outcomes = torch.randn(4, 10, 2, 1), torch.randn(4, 1, 2, 1)
+    returns, rewards = torch.randn(4, 10, 2, 1), torch.randn(4, 10, 2, 1)
+    lmb, gamma = 0.7, 0.9
+
+    lambda_values = deque([outcomes[:, -1]])
+    lambda_returns = deque([returns[:, -1]])
+    for i in range(values.size(1) - 2, -1, -1):
+        lambda_values.appendleft((1 - lmb) * values[:, i + 1] + lmb * lambda_values[0])
+        lambda_returns.appendleft(rewards[:, i] + gamma * ((1 - lmb) * returns[:, i + 1] + lmb * lambda_returns[0]))
+
+    deltas_v = torch.cat([(1 - lmb) * values[:, 1:], outcomes], dim=1)
+    deltas_r = torch.cat([rewards[:, :-1] + gamma * (1 - lmb) * returns[:, 1:], returns[:, -1:]], dim=1)
+    assert torch.allclose(backward_scan(deltas_v, torch.full_like(deltas_v, lmb)), torch.stack(tuple(lambda_values), dim=1), atol=1e-5)
+    assert torch.allclose(backward_scan(deltas_r, torch.full_like(deltas_r, gamma * lmb)), torch.stack(tuple(lambda_returns), dim=1), atol=1e-5)
+
+
+def padded_batch(episodes, args):
+    # episodes padded one by one as previously written in make_batch
+    obss, datum = [], []
+    for ep in episodes:
+        moments_ = sum([decode_block(ms) for ms in ep['moment']], [])
+        moments = moments_[ep['start'] - ep['base']:ep['end'] - ep['base']]
+        players = list(moments[0]['observation'].keys())
+
+        obs_zeros = map_r(moments[0]['observation'][moments[0]['turn']], lambda o: np.zeros_like(o))
+        if args['observation']:
+            obs = [[(lambda x: (x if x is not None else obs_zeros))(m['observation'][pl]) for pl in players] for m in moments]
+        else:
+            obs = [[m['observation'][m['turn']]] for m in moments]
+        obs = bimap_r(obs_zeros, rotate(rotate(obs)), lambda _, o: np.array(o))
+
+        v = np.array([[np.reshape(m['value'][pl], ()) if m['value'][pl] is not None else 0 for pl in players] for m in moments],
+                     dtype=np.float32).reshape(-1, len(players))
+        rew = np.array([[m['reward'][pl] or 0 for pl in players] for m in moments], dtype=np.float32).reshape(-1, len(players))
+        ret = np.array([[m['return'][pl] for pl in players] for m in moments], dtype=np.float32).reshape(-1, len(players))
+        oc = np.array([ep['outcome'][pl] for pl in players], dtype=np.float32).reshape(-1, len(players))
+        tmsk = np.array([[pl == m['turn'] for pl in players] for m in moments], dtype=np.float32)
+        pmsk = np.array([m['pmask'] for m in moments])
+        vmsk = np.ones_like(tmsk) if args['observation'] else tmsk
+        act = np.array([m['action'] for m in moments]).reshape(-1, 1)
+        p = np.array([m['policy'] for m in moments])
+        progress = np.arange(ep['start'], ep['end'], dtype=np.float32) / ep['total']
+
+        if len(tmsk) < args['forward_steps']:
+            pad_len = args['forward_steps'] - len(tmsk)
+            obs = map_r(obs, lambda o: np.pad(o, [(0, pad_len)] + [(0, 0)] * (len(o.shape) - 1), 'constant', constant_values=0))
+            v = np.concatenate([v, np.tile(oc, [pad_len, 1])])
+            rew = np.pad(rew, [(0, pad_len), (0, 0)], 'constant', constant_values=0)
+            ret = np.pad(ret, [(0, pad_len), (0, 0)], 'constant', constant_values=0)
+            tmsk = np.pad(tmsk, [(0, pad_len), (0, 0)], 'constant', constant_values=0)
+            pmsk = np.pad(pmsk, [(0, pad_len), (0, 0)], 'constant', constant_values=1e32)
+            vmsk = np.pad(vmsk, [(0, pad_len), (0, 0)], 'constant', constant_values=0)
+            act = np.pad(act, [(0, pad_len), (0, 0)], 'constant', constant_values=0)
+            p = np.pad(p, [(0, pad_len), (0, 0)], 'constant', constant_values=0)
+            progress = np.pad(progress, [(0, pad_len)], 'constant', constant_values=1)
+
+        obss.append(obs)
+        datum.append((tmsk, pmsk, vmsk, act, p, v, rew, ret, oc, progress))
+
+    keys = ['tmask', 'pmask', 'vmask', 'action', 'policy', 'value', 'reward', 'return', 'outcome', 'progress']
+    batch = {key: to_torch(np.array(d)) for key, d in zip(keys, zip(*datum))}
+    batch['observation'] = to_torch(bimap_r(obs_zeros, rotate(obss), lambda _, o: np.array(o)))
+    return batch
+
+
+@pytest.mark.parametrize('observation', [False, True])
+@pytest.mark.parametrize('forward_steps', [4, 16])
+def test_make_batch(observation, forward_steps):
+    """Test batch built into preallocated arrays matches episodes padded one by one"""
+    random.seed(0)
+    torch.manual_seed(0)
+    env_args = {'env': 'TicTacToe', 'source': 'handyrl.environments.tictactoe'}
+    args = {'observation': observation, 'forward_steps': forward_steps, 'compress_steps': 4, 'gamma': 0.8}
+    env = make_env(env_args)
+    model = SimpleConv2DModel(env)
+    generator = Generator(env, args)
+    episodes = []
+    while len(episodes) < 32:
+        ep = generator.generate({p: model for p in env.players()}, {'player': env.players(), 'model_id': {}})
+        st = random.randrange(1 + max(0, ep['steps'] - forward_steps))
+        ed = min(st + forward_steps, ep['steps'])
+        st_block, ed_block = st // 4, (ed - 1) // 4 + 1
+        episodes.append({
+            'id': len(episodes), 'args': ep['args'], 'outcome': ep['outcome'], 'moment': ep['moment'][st_block:ed_block],
+            'base': st_block * 4, 'start': st, 'end': ed, 'total': ep['steps'],
+        })
+
+    expected = padded_batch(episodes, args)
+    for batch in [make_batch(episodes, args), make_batch(episodes, args, BlockCache(1 << 20, np.zeros(2, dtype=np.int64)))]:
+        assert batch.keys() == expected.keys()
+        for key, x in expected.items():
+            y = batch[key]
+            for o, o_expected in zip(y.values() if isinstance(y, dict) else [y], x.values() if isinstance(x, dict) else [x]):
+                assert o.dtype == o_expected.dtype and torch.equal(o, o_expected), key
+
+    # padded turns after the end of each episode
+    lengths = [ep['end'] - ep['start'] for ep in episodes]
+    b = lengths.index(min(lengths))
+    if lengths[b] < forward_steps:
+        assert (batch['pmask'][b, lengths[b]:] == 1e32).all()
+        assert (batch['progress'][b, lengths[b]:] == 1).all()
+        assert (batch['tmask'][b, lengths[b]:] == 0).all()
+        assert torch.equal(batch['value'][b, lengths[b]:], batch['outcome'][b].expand(forward_steps - lengths[b], -1))
+
+
+def test_batch_slot():
+    """Test a batch slot sent once is refilled in place after released"""
+    def make(value):
+        return {
+            'observation': (torch.full((2, 3, 1, 4), value), torch.zeros(2, 3, 1, dtype=torch.bool)),
+            'action': torch.full((2, 3, 1), int(value), dtype=torch.int64), 'empty': torch.zeros(2, 0),
+        }
+
+    def batcher(conn):
+        slot = BatchSlot(make(1.0))
+        conn.send(slot)
+        conn.send(slot.fill(make(2.0)))  # still used
+        conn.recv()
+        conn.send(slot.fill({'action': torch.zeros(3)}))  # other shapes
+        conn.send(slot.fill(make(3.0)))
+
+    conn0, conn1 = mp.get_context('fork').Pipe()
+    process = mp.get_context('fork').Process(target=batcher, args=(conn1,))
+    process.start()
+    slot = conn0.recv()
+    assert not conn0.recv()
+    assert bimap_r(make(1.0), slot.tensors, lambda x, y: x.dtype == y.dtype and torch.equal(x, y)) == \
+        map_r(make(1.0), lambda _: True)
+    slot.release()
+    conn0.send(None)
+    assert not conn0.recv()
+    assert conn0.recv()
+    process.join()
+    assert torch.equal(slot.tensors['observation'][0], make(3.0)['observation'][0])
+    assert torch.equal(slot.tensors['action'], make(3.0)['action'])